@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""benchmarks for the phases of mcconf on synthetic module trees.
+
+The generator writes a module tree of configurable size together with a
+configuration that selects some of its modules. The benchmark runner loads
+mcconf from the parent directory and times module discovery, module parsing,
+include scanning, dependency resolution, installation, Makefile rendering and
+graph output separately. The results can be written as JSON and compared
+against the results of another commit.
+
+    bench/mcbench.py generate /tmp/tree --modules 2000
+    bench/mcbench.py run --tree /tmp/tree --json before.json
+    bench/mcbench.py run --tree /tmp/tree --compare before.json
+"""
+import sys
+import os
+import argparse
+import random
+import json
+import time
+import tempfile
+import shutil
+import subprocess
+import platform
+import logging
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, basedir)
+import mcconf
+
+def generateTree(dstdir, modules=500, files=4, fanout=3, tags=None, providers=1.5,
+                 conflicts=0.2, noauto=0.05, requires=2, selected=20, seed=1):
+    """writes a synthetic module tree and the configuration bench.config into dstdir.
+
+    Every module has files/2 headers and files/2 sources. Each source includes
+    the headers of its own module and fanout headers of lower numbered modules,
+    thus the include graph is acyclic. There are tags abstract tags, each
+    module requires requires of them. A tag is provided by a single module or,
+    with probability conflicts, by several alternative variant modules which
+    conflict with each other. The number of variants is chosen such that tags
+    have providers providers on average. Variants are never included by other
+    modules, hence the configuration stays satisfiable. A fraction noauto of
+    the other modules is excluded from automatic resolution, the configuration
+    selects one of them explicitly. Returns the path of the configuration file."""
+    rnd = random.Random(seed)
+    if tags is None: tags = max(1, modules//4)
+    tagnames = ['tag%04d' % t for t in range(tags)]
+    variants = max(2, int(round((providers-1) / conflicts)) + 1) if conflicts > 0 else 1
+    conflicted = [t for t in tagnames if conflicts > 0 and rnd.random() < conflicts]
+    regular = max(1, modules - variants*len(conflicted))
+    names = ['m%05d' % i for i in range(regular)]
+    names += ['v%05d' % i for i in range(modules - regular)]
+    nheaders = max(1, files//2)
+    nsources = max(0, files-nheaders)
+    headers = [['%s_%d.h' % (name, j) for j in range(nheaders)] for name in names]
+    isNoauto = [0 < i < regular and rnd.random() < noauto for i in range(len(names))]
+    targets = [i for i in range(regular) if not isNoauto[i]] # modules that can be included
+
+    provided = [list() for name in names]
+    variant = regular
+    for tag in tagnames:
+        if tag in conflicted:
+            for k in range(variants):
+                if variant < len(names): provided[variant].append(tag)
+                variant += 1
+        else:
+            provided[rnd.choice(targets)].append(tag)
+
+    moddir = os.path.join(dstdir, 'modules')
+    for i, name in enumerate(names):
+        mdir = os.path.join(moddir, 'group%03d' % (i//50), name)
+        if not os.path.isdir(mdir): os.makedirs(mdir)
+        for h in headers[i]:
+            with open(os.path.join(mdir, h), 'w') as f:
+                f.write('#pragma once\nint %s(int);\n' % h[:-2].replace('.', '_'))
+        sources = ['%s_%d.cc' % (name, j) for j in range(nsources)]
+        below = [t for t in targets if t < i]
+        for j, src in enumerate(sources):
+            incs = list(headers[i])
+            if below:
+                for k in range(fanout):
+                    incs.append(rnd.choice(headers[rnd.choice(below)]))
+            with open(os.path.join(mdir, src), 'w') as f:
+                for inc in incs: f.write('#include "%s"\n' % inc)
+                f.write('#include <stdint.h>\n\n')
+                f.write('int %s_f%d(int x) { return x + %d; }\n' % (name, j, i))
+        reqs = sorted(set(rnd.choice(tagnames) for k in range(requires)) - set(provided[i]))
+        with open(os.path.join(mdir, name+'.module'), 'w') as f:
+            f.write('[module.%s]\n' % name)
+            f.write('incfiles = [ "*.h" ]\n')
+            if sources: f.write('srcfiles = [ "*.cc" ]\n')
+            f.write('requires = [ %s ]\n' % ', '.join('"%s"' % t for t in reqs))
+            f.write('provides = [ %s ]\n' % ', '.join('"%s"' % t for t in provided[i]))
+            if isNoauto[i]: f.write('noauto = true\n')
+            if i % 10 == 0:
+                f.write("makefile_head = 'M%d_FLAGS = ${vars.benchflags}'\n" % i)
+
+    top = [names[i] for i in targets[-max(1, selected):]]
+    top += [names[i] for i in range(regular) if isNoauto[i]][:1]
+    conffile = os.path.join(dstdir, 'bench.config')
+    with open(conffile, 'w') as f:
+        f.write('[config]\n')
+        f.write('moduledirs = [ "modules" ]\n')
+        f.write("destdir = 'out'\n")
+        f.write('provides = [ "x86", "stdint.h" ]\n')
+        f.write('requires = [ "Makefile" ]\n')
+        f.write('modules = [ %s ]\n' % ', '.join('"%s"' % n for n in top))
+        f.write('\n[config.vars]\nbenchflags = "-DBENCH"\n')
+    return conffile
+
+def measure(fn, repeat, setup=None):
+    """runs setup() and fn() repeat times and returns the times spent in fn."""
+    times = list()
+    for r in range(repeat):
+        if setup: setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+class Bench:
+    """holds the state shared by the benchmarks of one module tree."""
+
+    def __init__(self, conffile, workdir, jobs):
+        self.conffile = os.path.abspath(conffile)
+        self.workdir = workdir
+        self.jobs = jobs
+        conf = mcconf.readTomlConfiguration(self.conffile)
+        self.paths = [os.path.abspath(os.path.join(os.path.dirname(self.conffile), p))
+                      for p in conf.moduledirs]
+        self.parsed = mcconf.parseModuleDirs(self.paths)
+        self.modules = [mod for path, found in self.parsed
+                        for modulefile, mods in found for mod in mods]
+        self.config = None
+
+    def newConfiguration(self):
+        config = mcconf.readTomlConfiguration(self.conffile)
+        for mod in self.modules: config.modDB.addModule(mod)
+        return config
+
+    def discover(self):
+        for path in self.paths:
+            index = mcconf.DirIndex(path)
+            mcconf.findFiles(path, ["**/*.module", "**/mcconf.toml", "**/*.mcconf"], index)
+
+    def parse(self):
+        mcconf.parseModuleDirs(self.paths, None, self.jobs)
+
+    def parseCached(self):
+        cache = mcconf.ModuleCache(os.path.join(self.workdir, 'modules.cache'))
+        cache.load()
+        mcconf.parseModuleDirs(self.paths, cache)
+
+    def warmCache(self):
+        cachefile = os.path.join(self.workdir, 'modules.cache')
+        if os.path.exists(cachefile): return
+        cache = mcconf.ModuleCache(cachefile)
+        mcconf.parseModuleDirs(self.paths, cache)
+        cache.save()
+
+    def forgetIncludes(self, memo=False):
+        if memo: mcconf.includeScanner.memo.clear()
+        for mod in self.modules: mod.forgetIncludes()
+
+    def scanIncludes(self):
+        for mod in self.modules: mod.requiredFiles
+
+    def resolve(self, solver):
+        config = self.newConfiguration()
+        config.processModules(True, solver)
+        return config
+
+    def resolved(self):
+        if self.config is None:
+            self.config = self.resolve('sat')
+            self.config.dstdir = os.path.join(self.workdir, 'out')
+            self.modes = dict((mf, mf.installMode) for mf in self.config.allfiles.values())
+        return self.config
+
+    def setInstallMode(self, mode, clean=True):
+        """selects the install mode of all files except the templates."""
+        self.resolved()
+        for mf, orig in self.modes.items():
+            mf.installMode = orig if orig == 'mako' else mode
+        if clean and os.path.isdir(self.config.dstdir): shutil.rmtree(self.config.dstdir)
+
+    def restoreInstallMode(self):
+        for mf, mode in self.modes.items(): mf.installMode = mode
+
+    def installed(self):
+        """installs the configuration in link mode unless it is already there."""
+        self.setInstallMode('link', False)
+        if not os.path.exists(os.path.join(self.config.dstdir, 'mcconf.db')): self.install()
+
+    def copied(self):
+        """installs the configuration in copy mode over an existing copy."""
+        self.setInstallMode('copy', clean=False)
+        self.install()
+
+    def install(self, incremental=False):
+        self.resolved().install(incremental, self.jobs)
+
+    def renderMakefile(self):
+        config = self.resolved()
+        mf = config.allfiles['Makefile']
+        tgtfile = os.path.join(config.dstdir, 'Makefile')
+        mf.render(os.path.abspath(mf.srcfile), tgtfile, config.templateEnv())
+
+    def graphs(self):
+        config = self.resolved()
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            mcconf.createModulesGraph(config.modDB)
+            mcconf.createConfigurationGraph(config.acceptedMods, config.modules, config.modDB,
+                                            os.path.join(self.workdir, 'config.dot'))
+        finally:
+            os.chdir(cwd)
+
+    def startup(self):
+        """starts a new interpreter that only imports mcconf."""
+        subprocess.check_call([sys.executable, '-c', 'import sys; sys.path.insert(0, %r); import mcconf'
+                               % basedir])
+
+    def lookup(self):
+        """looks up a file with the generated mcconf helper of the installed configuration."""
+        config = self.resolved()
+        name = sorted(config.allfiles)[len(config.allfiles)//2]
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, os.path.join(config.dstdir, 'mcconf'), '-f', name],
+                                  stdout=devnull)
+
+def runBenchmarks(bench, repeat, only=None):
+    """runs the benchmarks and returns a list of (name, times)."""
+    def clearTemplates():
+        mcconf.templateCache.templates.clear()
+    benchmarks = [
+        ('discover', bench.discover, None),
+        ('parse', bench.parse, None),
+        ('parse cached', bench.parseCached, bench.warmCache),
+        ('scan includes', bench.scanIncludes, lambda: bench.forgetIncludes(True)),
+        ('scan includes memoized', bench.scanIncludes, bench.forgetIncludes),
+        ('resolve greedy', lambda: bench.resolve('greedy'), bench.scanIncludes),
+        ('resolve sat', lambda: bench.resolve('sat'), bench.scanIncludes),
+    ]
+    for mode in ['link', 'hardlink', 'copy', 'cinclude']:
+        benchmarks.append(('install '+mode, bench.install,
+                           lambda mode=mode: bench.setInstallMode(mode)))
+    benchmarks += [
+        ('install copy unchanged', bench.install, bench.copied),
+        ('install incremental', lambda: bench.install(True), bench.installed),
+        ('render Makefile', bench.renderMakefile, clearTemplates),
+        ('render Makefile cached', bench.renderMakefile, None),
+        ('graphs', bench.graphs, None),
+        ('startup', bench.startup, None),
+        ('lookup', bench.lookup, bench.installed),
+    ]
+    results = list()
+    for name, fn, setup in benchmarks:
+        if only and not any(name.startswith(o) for o in only): continue
+        logging.info('running %s', name)
+        results.append((name, measure(fn, repeat, setup)))
+    if bench.config is not None: bench.restoreInstallMode()
+    return results
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n//2] if n % 2 else (values[n//2-1] + values[n//2]) / 2.0
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, baseline, threshold):
+    """prints the ratio to the baseline results and returns the names of all
+    benchmarks that got slower by more than the threshold."""
+    regressions = list()
+    print('\n%-26s %10s %10s %7s' % ('compared to '+str(baseline.get('commit')), 'before', 'after', 'ratio'))
+    for name, entry in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None or old['min'] <= 0: continue
+        ratio = entry['min'] / old['min']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = ' slower'
+        print('%-26s %9.4fs %9.4fs %6.2fx%s' % (name, old['min'], entry['min'], ratio, flag))
+    return regressions
+
+def generatorArgs(parser):
+    parser.add_argument('--modules', type=int, default=500, help = 'number of modules')
+    parser.add_argument('--files', type=int, default=4, help = 'files per module, half of them headers')
+    parser.add_argument('--fanout', type=int, default=3, help = 'headers of other modules included by each source')
+    parser.add_argument('--tags', type=int, default=None, help = 'number of abstract tags, default modules/4')
+    parser.add_argument('--providers', type=float, default=1.5, help = 'average number of providers per tag')
+    parser.add_argument('--conflicts', type=float, default=0.2, help = 'fraction of tags with alternative providers')
+    parser.add_argument('--noauto', type=float, default=0.05, help = 'fraction of noauto modules')
+    parser.add_argument('--requires', type=int, default=2, help = 'tags required by each module')
+    parser.add_argument('--selected', type=int, default=20, help = 'modules selected by the configuration')
+    parser.add_argument('--seed', type=int, default=1, help = 'seed of the random generator')
+
+def generatorParams(args):
+    return dict((k, getattr(args, k)) for k in ['modules', 'files', 'fanout', 'tags', 'providers',
+                                                 'conflicts', 'noauto', 'requires', 'selected', 'seed'])
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic benchmarks for mcconf')
+    sub = parser.add_subparsers(dest='command')
+    gen = sub.add_parser('generate', help = 'write a synthetic module tree')
+    gen.add_argument('dstdir', help = 'directory for the module tree and bench.config')
+    generatorArgs(gen)
+    run = sub.add_parser('run', help = 'run the benchmarks')
+    run.add_argument('--tree', help = 'use a tree written by generate instead of a temporary one')
+    generatorArgs(run)
+    run.add_argument('-r', '--repeat', type=int, default=3, help = 'repetitions of each benchmark')
+    run.add_argument('-j', '--jobs', type=int, default=1, help = 'jobs passed to parsing and install')
+    run.add_argument('--only', nargs='+', help = 'run only benchmarks whose names start with one of these')
+    run.add_argument('--json', help = 'write the results to a JSON file')
+    run.add_argument('--compare', help = 'compare against the results in a JSON file')
+    run.add_argument('--threshold', type=float, default=1.25,
+                     help = 'ratio above which a benchmark counts as regression')
+    parser.add_argument('-v', '--verbose', action='store_true', help = 'log the progress')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format='%(levelname)s: %(message)s')
+    if args.command == 'generate':
+        print(generateTree(args.dstdir, **generatorParams(args)))
+        return 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    workdir = tempfile.mkdtemp(prefix='mcbench-')
+    try:
+        params = None
+        if args.tree:
+            conffile = os.path.join(args.tree, 'bench.config')
+        else:
+            params = generatorParams(args)
+            start = time.perf_counter()
+            conffile = generateTree(os.path.join(workdir, 'tree'), **params)
+            logging.info('generated tree in %.2fs', time.perf_counter() - start)
+        bench = Bench(conffile, workdir, args.jobs)
+        results = runBenchmarks(bench, args.repeat, args.only)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    data = {'commit': gitCommit(), 'python': platform.python_version(),
+            'tree': os.path.abspath(args.tree) if args.tree else None, 'params': params,
+            'modules': len(bench.modules), 'repeat': args.repeat, 'jobs': args.jobs,
+            'results': dict((name, {'min': min(t), 'median': median(t), 'runs': t})
+                            for name, t in results)}
+    print('%-26s %10s %10s' % ('benchmark', 'min', 'median'))
+    for name, t in results:
+        print('%-26s %9.4fs %9.4fs' % (name, min(t), median(t)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(data, baseline, args.threshold): return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
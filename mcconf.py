@@ -2,29 +2,498 @@
 import sys
 import os
 
-# used to access the mcconf default files
-mcconf_dir = os.path.dirname(sys.argv[0])
+# used to access the mcconf default files, also when mcconf is imported as library
+mcconf_dir = os.path.dirname(os.path.abspath(__file__))
+# rerun by the generated mcconf helper, see the var mcconf
+mcconf_script = os.path.join(mcconf_dir, 'mcconf.py')
 
+# modules that only some modes need (mako, pathlib2, multiprocessing, socket, ...)
+# are imported where they are used, which keeps the startup of --check runs short
 import toml
-from pathlib2 import Path
 import logging
 import argparse
 import re
-#import pydotplus.graphviz as pydot
-import pydot
 import shutil
-import mako.template
-import mako.runtime
-
-def findFiles(basedir, patterns):
+import stat
+import errno
+import io
+import pickle
+import hashlib
+import threading
+import contextlib
+import heapq
+import collections
+import time
+import fnmatch
+import types
+
+def findFiles(basedir, patterns, index=None):
     """find files relative to a base directory according to a list of patterns.
+    The patterns are matched against the DirIndex if it covers the base directory.
     Returns a set of file names."""
     files = set()
-    path = Path(basedir)
     for pattern in patterns:
-        files.update([m.relative_to(basedir).as_posix() for m in path.glob(pattern)])
+        matches = index.glob(basedir, pattern) if index else None
+        if matches is None:
+            from pathlib2 import Path
+            matches = [m.relative_to(basedir).as_posix() for m in Path(basedir).glob(pattern)]
+        files.update(matches)
     return files
 
+class DirIndex:
+    """an in-memory index of a directory tree that is built by a single walk.
+
+    Attributes:
+        root  the absolute path to the indexed directory.
+        dirs  a dictionary from directory path relative to the root ('' for the root)
+              to a tuple (list of subdirectory names, list of file names,
+              set of subdirectory names that are symbolic links).
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.dirs = dict()
+        self._walk('', set())
+
+    def _walk(self, reldir, parents):
+        subdirs = list()
+        files = list()
+        links = set()
+        self.dirs[reldir] = (subdirs, files, links)
+        try:
+            st = os.stat(os.path.join(self.root, reldir))
+            if (st.st_dev, st.st_ino) in parents: return # symlink cycle
+            entries = list(os.scandir(os.path.join(self.root, reldir)))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                subdirs.append(entry.name)
+                if entry.is_symlink(): links.add(entry.name)
+            else: files.append(entry.name)
+        parents.add((st.st_dev, st.st_ino))
+        for name in subdirs:
+            self._walk(self._join(reldir, name), parents)
+        parents.discard((st.st_dev, st.st_ino))
+
+    @staticmethod
+    def _join(reldir, name):
+        return reldir + '/' + name if reldir else name
+
+    def _descendants(self, reldir):
+        """all directories below reldir including itself, without following symbolic links."""
+        result = [reldir]
+        subdirs, files, links = self.dirs[reldir]
+        for name in subdirs:
+            if name not in links:
+                result.extend(self._descendants(self._join(reldir, name)))
+        return result
+
+    def glob(self, basedir, pattern):
+        """match a pattern like Path.glob, relative to a directory inside the index.
+        Returns a list of names relative to basedir or None if the index cannot answer."""
+        base = os.path.relpath(os.path.abspath(basedir), self.root)
+        if base == '.': base = ''
+        if base.startswith('..') or base not in self.dirs: return None
+        parts = [p for p in pattern.split('/') if p not in ('', '.')]
+        if '..' in parts or not parts: return None
+        level = [base]
+        matches = list()
+        for i, part in enumerate(parts):
+            last = (i == len(parts)-1)
+            if part == '**':
+                level = [d for l in level for d in self._descendants(l)]
+                if last: matches = level
+                continue
+            nextlevel = list()
+            for l in level:
+                subdirs, files, links = self.dirs[l]
+                names = subdirs + files if last else subdirs
+                if re.search('[*?[]', part):
+                    nextlevel.extend(self._join(l, n) for n in names
+                                     if fnmatch.fnmatchcase(n, part))
+                elif part in names:
+                    nextlevel.append(self._join(l, part))
+            level = nextlevel
+            if last: matches = level
+        return ['.' if m == base else m[len(base)+1:] if base else m for m in matches]
+
+def findFileDirs(basedir, patterns):
+    """find all directories whose listing can influence the result of findFiles.
+    Returns a set of absolute directory names."""
+    dirs = set()
+    for pattern in patterns:
+        level = [basedir]
+        for part in pattern.split('/')[:-1]:
+            dirs.update(level)
+            if part == '**':
+                level = [d for l in level for d,_,_ in os.walk(l)]
+            elif re.search('[*?[]', part):
+                level = [os.path.join(l, n) for l in level if os.path.isdir(l)
+                         for n in os.listdir(l) if fnmatch.fnmatch(n, part)]
+            else:
+                level = [os.path.join(l, part) for l in level]
+        dirs.update(level)
+    return set(os.path.abspath(d) for d in dirs)
+
+def statKey(path):
+    """a cheap fingerprint of a file or directory, None if it does not exist."""
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+class Stats:
+    """collects the wall and cpu time per phase and event counters of a run.
+
+    Phases may be nested, the time of a phase includes its nested phases.
+    The cpu time covers all threads but not the worker processes.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.startedCpu = time.process_time()
+        self.phases = dict() # name -> [calls, wall time, cpu time]
+        self.counters = dict()
+        self.trace = list()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, trace=True):
+        """measure a phase, trace=False omits it from the trace, e.g. for frequent phases."""
+        wall = time.time()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            dwall = time.time() - wall
+            dcpu = time.process_time() - cpu
+            with self.lock:
+                entry = self.phases.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += dwall
+                entry[2] += dcpu
+                if trace:
+                    self.trace.append({'phase': name, 'start': wall - self.started,
+                                       'wall': dwall, 'cpu': dcpu})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        logging.info('%-24s %10s %10s %8s', 'phase', 'wall[s]', 'cpu[s]', 'calls')
+        for name in self.phases:
+            calls, wall, cpu = self.phases[name]
+            logging.info('%-24s %10.3f %10.3f %8d', name, wall, cpu, calls)
+        logging.info('%-24s %10.3f %10.3f', 'total',
+                     time.time() - self.started, time.process_time() - self.startedCpu)
+        for name in sorted(self.counters):
+            logging.info('%-24s %10d', name, self.counters[name])
+
+    def writeJson(self, filename):
+        data = {'command': sys.argv,
+                'started': self.started,
+                'total': {'wall': time.time() - self.started,
+                          'cpu': time.process_time() - self.startedCpu},
+                'phases': dict((name, {'calls': e[0], 'wall': e[1], 'cpu': e[2]})
+                               for name, e in self.phases.items()),
+                'counters': self.counters,
+                'trace': self.trace}
+        import json
+        with open(filename, 'w') as fout:
+            json.dump(data, fout, indent=1, sort_keys=True)
+
+stats = Stats()
+
+
+
+class IncludeScanner:
+    """memoizes the include directives found in source files.
+
+    The memo maps the path of a source file to its fingerprint, the hash of
+    its content, and the list(string) of included names. A file is read again
+    only if its fingerprint changed, and scanned again only if its content changed.
+    The scanner is chosen by the file suffix, files of other types are not read.
+    With jobs > 1, prefetch scans outdated files in a pool of worker processes.
+    """
+    incrgx = re.compile(b'^#include\\s+[<\\"]([\\w./-]+)[>\\"]', re.MULTILINE)
+    asmrgx = re.compile(b'^(?:#include|[ \\t]*\\.include)\\s+[<\\"]([\\w./-]+)[>\\"]', re.MULTILINE)
+    scanners = dict.fromkeys(['.c', '.cc', '.cpp', '.cxx', '.h', '.hh', '.hpp', '.hxx'], incrgx)
+    scanners.update(dict.fromkeys(['.S', '.s'], asmrgx))
+    mmapSize = 1 << 20 # larger files are mapped instead of read
+
+    def __init__(self):
+        self.memo = dict()
+        self.dirty = False
+        self.jobs = 1
+
+    @classmethod
+    def scanner(cls, srcfile):
+        """Return the regular expression for the includes of the file or None."""
+        return cls.scanners.get(os.path.splitext(srcfile)[1])
+
+    @classmethod
+    def read(cls, srcfile, size, entry=None):
+        """Return the hash of the content and the included names of a file.
+        The names of the memo entry are reused if the content did not change."""
+        with open(srcfile, 'rb') as fin:
+            if size < cls.mmapSize:
+                data = fin.read()
+            else:
+                import mmap
+                data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest = hashlib.sha1(data).hexdigest()
+                if entry is not None and entry[1] == digest: return digest, entry[2]
+                return digest, [sys.intern(m.group(1).decode()) for m in cls.scanner(srcfile).finditer(data)]
+            finally:
+                if not isinstance(data, bytes): data.close()
+
+    def scan(self, srcfile):
+        key = statKey(srcfile)
+        entry = self.memo.get(srcfile)
+        if entry is not None and entry[0] == key:
+            stats.count('sources memoized')
+            return entry[2]
+        stats.count('sources scanned')
+        if key is None: raise IOError('cannot access ' + srcfile)
+        digest, includes = self.read(srcfile, key[1], entry)
+        self.memo[srcfile] = (key, digest, includes)
+        self.dirty = True
+        return includes
+
+    def prefetch(self, srcfiles):
+        """scan all outdated files of the list in parallel."""
+        pending = sorted(set(f for f in srcfiles
+                             if f not in self.memo or self.memo[f][0] != statKey(f)))
+        if self.jobs < 2 or len(pending) < 2: return
+        import multiprocessing
+        pool = multiprocessing.Pool(min(self.jobs, len(pending)))
+        try:
+            results = pool.map(scanIncludes, pending)
+        finally:
+            pool.close()
+            pool.join()
+        stats.count('sources scanned', len(pending))
+        for srcfile, entry in zip(pending, results):
+            if entry is not None:
+                self.memo[srcfile] = entry
+                self.dirty = True
+
+def scanIncludes(srcfile):
+    """scan a source file in a worker process.
+    Returns the memo entry for the file or None if it could not be read."""
+    try:
+        key = statKey(srcfile)
+        return (key,) + IncludeScanner.read(srcfile, key[1])
+    except Exception:
+        return None
+
+includeScanner = IncludeScanner()
+
+class TemplateCache:
+    """compiles each mako template text at most once.
+
+    Compiled templates are kept in memory, keyed by the hash of their source.
+    If a directory is set, the generated python code is stored there as well
+    and later runs load it instead of compiling the template again.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.templates = dict()
+        self.compiled = 0
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def getFile(self, filename):
+        with open(filename, 'r') as fin:
+            return self.get(fin.read(), filename)
+
+    def get(self, text, uri=None):
+        """Return the compiled template for the text, uri is used in error messages."""
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        tmpl = self.templates.get(key)
+        if tmpl is not None: return tmpl
+        with self.lock: # files may be installed by several threads
+            tmpl = self.templates.get(key)
+            if tmpl is None:
+                tmpl = self._load(key, text)
+                if tmpl is None:
+                    import mako.template
+                    tmpl = mako.template.Template(text, uri=uri or key, imports=['import os'])
+                    self.compiled += 1
+                    stats.count('templates compiled')
+                    self._store(key, tmpl.code)
+                self.templates[key] = tmpl
+        return tmpl
+
+    def _load(self, key, text):
+        if not self.directory: return None
+        path = os.path.join(self.directory, key+'.py')
+        if not os.path.exists(path): return None
+        try:
+            with open(path, 'r') as fin:
+                code = fin.read()
+            import mako.template, mako.codegen
+            module = types.ModuleType('mcconf_template_'+key)
+            exec(compile(code, path, 'exec'), module.__dict__)
+            if module._magic_number != mako.codegen.MAGIC_NUMBER: return None
+            self.loaded += 1
+            return mako.template.ModuleTemplate(module, module_filename=path,
+                                                template_source=text)
+        except Exception as e:
+            logging.debug('ignoring cached template %s: %s', path, e)
+            return None
+
+    def _store(self, key, code):
+        if not self.directory: return
+        path = os.path.join(self.directory, key+'.py')
+        try:
+            if not os.path.exists(self.directory): os.makedirs(self.directory)
+            with open(path+'.tmp', 'w') as fout:
+                fout.write(code)
+            os.rename(path+'.tmp', path)
+        except (IOError, OSError) as e:
+            logging.debug('could not store compiled template %s: %s', path, e)
+
+templateCache = TemplateCache()
+
+
+class FileCopier:
+    """copies and hardlinks source files into the destination.
+
+    A target that is a regular file with the same size and modification time
+    as its source, as left behind by a previous copy, or with the same content
+    is not written again. Files are cloned with the FICLONE ioctl if the file
+    system supports reflinks, otherwise copied in the kernel with
+    copy_file_range or sendfile, and only as last resort through a buffer.
+    Methods that fail for a pair of devices are not tried again for it.
+    """
+    FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+    unsupported = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.ENOTTY, errno.EBADF, errno.EPERM)
+    chunkSize = 1 << 20
+
+    def __init__(self):
+        self.failed = set() # (method, src device, dst device)
+        self.methods = [('reflink', self.reflink)]
+        if hasattr(os, 'copy_file_range'): self.methods.append(('copy_file_range', self.copyFileRange))
+        if hasattr(os, 'sendfile'): self.methods.append(('sendfile', self.sendfile))
+
+    def isSame(self, srcfile, tgtfile):
+        """test whether the target is a regular file with the content of the source.
+        The content is compared only if the sizes match but the times do not."""
+        try:
+            src = os.stat(srcfile)
+            tgt = os.lstat(tgtfile)
+        except OSError:
+            return False
+        if not stat.S_ISREG(tgt.st_mode) or src.st_size != tgt.st_size: return False
+        if (src.st_dev, src.st_ino) == (tgt.st_dev, tgt.st_ino): return True
+        mtime = lambda st: getattr(st, 'st_mtime_ns', st.st_mtime)
+        if mtime(src) == mtime(tgt): return True
+        with open(srcfile, 'rb') as fsrc, open(tgtfile, 'rb') as ftgt:
+            while True:
+                a = fsrc.read(self.chunkSize)
+                if a != ftgt.read(self.chunkSize): return False
+                if not a: return True
+
+    def reflink(self, fsrc, ftgt, size):
+        import fcntl
+        fcntl.ioctl(ftgt.fileno(), self.FICLONE, fsrc.fileno())
+
+    def copyFileRange(self, fsrc, ftgt, size):
+        copied = 0
+        while copied < size:
+            n = os.copy_file_range(fsrc.fileno(), ftgt.fileno(), size - copied)
+            if n == 0: break # the source got shorter
+            copied += n
+
+    def sendfile(self, fsrc, ftgt, size):
+        copied = 0
+        while copied < size:
+            n = os.sendfile(ftgt.fileno(), fsrc.fileno(), copied, size - copied)
+            if n == 0: break
+            copied += n
+
+    def copy(self, srcfile, tgtfile):
+        """copy the content, permissions and times of the source to a new target."""
+        with open(srcfile, 'rb') as fsrc, open(tgtfile, 'wb') as ftgt:
+            src = os.fstat(fsrc.fileno())
+            devs = (src.st_dev, os.fstat(ftgt.fileno()).st_dev)
+            for name, method in self.methods:
+                if (name,)+devs in self.failed: continue
+                try:
+                    method(fsrc, ftgt, src.st_size)
+                    stats.count('files copied ('+name+')')
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno not in self.unsupported: raise
+                    logging.debug('cannot use %s for %s: %s', name, tgtfile, e)
+                    self.failed.add((name,)+devs)
+                    fsrc.seek(0)
+                    ftgt.seek(0)
+                    ftgt.truncate()
+            else:
+                shutil.copyfileobj(fsrc, ftgt, self.chunkSize)
+                stats.count('files copied (buffered)')
+        shutil.copystat(srcfile, tgtfile)
+
+    def link(self, srcfile, tgtfile):
+        """hardlink the source to a new target, or copy it if the target is
+        on another device or the file system does not support hardlinks."""
+        try:
+            os.link(srcfile, tgtfile)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK): raise
+            logging.debug('cannot hardlink %s, copying it: %s', tgtfile, e)
+            self.copy(srcfile, tgtfile)
+
+fileCopier = FileCopier()
+
+
+
+class TagTable:
+    """interns tags, i.e. symbols, pseudo modules and file names, as bit positions.
+
+    Sets of tags are represented as int bitsets, so that the resolver checks
+    conflicts and missing requires with bitwise operations. Tags keep their
+    position for the lifetime of the process, bitsets are not pickled.
+    """
+
+    def __init__(self):
+        self.ids = dict() # tag -> bit position
+        self.tags = list() # bit position -> tag
+
+    def bits(self, tags):
+        """Return the bitset of an iterable of tags, interning new tags."""
+        bits = 0
+        for tag in tags:
+            i = self.ids.get(tag)
+            if i is None:
+                i = self.ids[tag] = len(self.tags)
+                self.tags.append(tag)
+            bits |= 1 << i
+        return bits
+
+    def decode(self, bits):
+        """Return the list of tags of a bitset in the order of their positions."""
+        digits = bin(bits)[:1:-1] # least significant bit first
+        tags = list()
+        i = digits.find('1')
+        while i >= 0:
+            tags.append(self.tags[i])
+            i = digits.find('1', i+1)
+        return tags
+
+tagTable = TagTable()
 
 
 class ModFile:
@@ -34,16 +503,16 @@ class ModFile:
         module  the module this file belongs to, used for path resolution.
         srcname the path to the source file as given in the module definition,
                 relative to the module file.
-        srcfile the absolute path to the source file.
+        srcfile the absolute path to the source file, derived from the module.
         dstfile the relative path to the destination file, relative to the target root.
         installMode how this file will be installed (link, hardlink, cinclude, copy).
     """
+    __slots__ = ('installMode', 'module', 'srcname', 'dstfile')
 
     def __init__(self, module, filename):
         self.installMode = 'link'
         self.module = module
         self.srcname = filename
-        self.srcfile = os.path.join(self.module.moduledir, self.srcname)
         dstpath = os.path.join(self.module.dstdir, os.path.dirname(filename))
         dstname = os.path.basename(filename)
         if dstname.startswith("mako_"):
@@ -54,67 +523,89 @@ class ModFile:
     def __repr__(self): return self.dstfile
 
     @property
-    def dependencies(self):
-        """a list(string) with all C/C++ include dependencies"""
-        incrgx = re.compile('^#include\\s+[<\\"]([\\w./-]+)[>\\"]', re.MULTILINE)
-        # TODO detect the file type and choose a respective scanner instead
-        # of handling all files as source files
+    def srcfile(self): return os.path.join(self.module.moduledir, self.srcname)
+
+    @property
+    def isScanned(self):
+        """whether the file is scanned for includes, templates and files
+        without a scanner for their type are not."""
+        return self.installMode != 'mako' and IncludeScanner.scanner(self.srcfile) is not None
+
+    def dependencies(self, known):
+        """a list(string) with all C/C++ include dependencies.
+        Includes relative to the file that name one of the module's files are
+        resolved through known, a dictionary from source name to destination file."""
         # TODO scan for special syntax that declares required and provided symbols for mcconf
         includes = list()
-        srcdir = os.path.dirname(self.srcfile)
+        if not self.isScanned: return includes
+        srcdir = os.path.dirname(self.srcname)
         try:
-            with open(self.srcfile) as fin:
-                for m in incrgx.finditer(fin.read()):
-                    inc = m.group(1)
-                    # if file is locally referenced e.g. 'foo' instead of 'path/to/foo'
-                    # TODO this will break when we begin to rename files during composition
-                    # ie. will have to check if moduledir/inc is one of the modules dstfiles
-                    # would be better, to prohibit this per convention,
-                    # ie "" always relative to sourcefile, <> always relative to the logical root
-                    if os.path.exists(os.path.join(srcdir,inc)):
-                        inc = os.path.relpath(os.path.join(srcdir,inc),
-                                                  self.module.moduledir)
-                    includes.append(inc)
+            for inc in includeScanner.scan(self.srcfile):
+                # if file is locally referenced e.g. 'foo' instead of 'path/to/foo'
+                # it is replaced by the name of the installed file
+                local = known.get(os.path.normpath(os.path.join(srcdir, inc)))
+                includes.append(local if local is not None else inc)
         except Exception as e:
-            logging.warning("could not load %s from %s: %s", fpath, self.modulefile, e)
+            logging.warning("could not load %s from %s: %s",
+                            self.srcfile, self.module.modulefile, e)
         return includes
 
     @property
     def isCopy(self): return self.installMode not in ["link","hardlink"]
 
-    def install(self, tgtdir, tmplenv):
-        """install the file into the target directory."""
+    def render(self, srcfile, tgtfile, tmplenv):
+        """Return the content of a generated file or None if the file is linked or copied."""
+        if self.installMode=='cinclude':
+            return '#include "'+os.path.relpath(srcfile, tgtfile)+'"\n'
+        elif self.installMode=='mako':
+            import mako.runtime
+            buf = io.StringIO()
+            tmpl = templateCache.getFile(self.srcfile)
+            ctx = mako.runtime.Context(buf, **tmplenv)
+            tmpl.render_context(ctx)
+            stats.count('templates rendered')
+            return buf.getvalue()
+        return None
+
+    def isUpToDate(self, srcfile, tgtfile, content):
+        """test whether the existing target file already matches the source."""
+        try:
+            if self.installMode=='link':
+                return (os.path.islink(tgtfile) and os.readlink(tgtfile) ==
+                        os.path.relpath(srcfile, os.path.dirname(tgtfile)))
+            if os.path.islink(tgtfile) or not os.path.isfile(tgtfile): return False
+            if self.installMode=='hardlink':
+                # a copy is fine if the hardlink fell back to copying
+                return fileCopier.isSame(srcfile, tgtfile)
+            if content is not None:
+                with open(tgtfile, 'r') as f:
+                    if f.read() != content: return False
+                return (self.installMode!='mako' or
+                        stat.S_IMODE(os.stat(srcfile).st_mode) == stat.S_IMODE(os.stat(tgtfile).st_mode))
+            return fileCopier.isSame(srcfile, tgtfile)
+        except (OSError, IOError, UnicodeDecodeError):
+            return False
+
+    def plan(self, tgtdir, tmplenv, incremental=False, role=''):
+        """Return the InstallStep that installs the file into the target directory.
+        Templates are rendered now. In incremental mode, a target that already
+        has the same link target or content is kept, copied and hardlinked
+        files are also kept otherwise."""
         srcfile = os.path.abspath(self.srcfile)
         tgtfile = os.path.abspath(os.path.join(tgtdir, self.dstfile))
 
-        logging.debug('installing file %s to %s mode %s from module %s',
-                          srcfile, tgtfile, self.installMode, self.module)
         if not os.path.isfile(srcfile):
             logging.warning('file %s is missing or not regular file, provided by %s from %s',
                             self.srcfile, self.module, self.module.modulefile)
 
-        if not os.path.exists(os.path.dirname(tgtfile)):
-            os.makedirs(os.path.dirname(tgtfile))
-        # TODO ideally we should never overwrite files, reconfig run should delete previously installed files
-        if os.path.exists(tgtfile) or os.path.islink(tgtfile):
-            os.unlink(tgtfile)
-
-        if self.installMode=='link':
-            os.symlink(os.path.relpath(srcfile, os.path.dirname(tgtfile)), tgtfile)
-        elif self.installMode=='hardlink':
-            os.link(srcfile, tgtfile)
-        elif self.installMode=='cinclude':
-            with open(tgtfile, 'w') as f:
-                f.write('#include "'+os.path.relpath(srcfile, tgtfile)+'"\n')
-        elif self.installMode=='mako':
-            with open(tgtfile, 'w') as f:
-                tmpl = mako.template.Template(filename=self.srcfile,
-                         imports=['import os'])
-                ctx = mako.runtime.Context(f, **tmplenv)
-                tmpl.render_context(ctx)
-            shutil.copymode(srcfile, tgtfile)
-        else: # copy the file
-            shutil.copy2(srcfile, tgtfile)
+        content = self.render(srcfile, tgtfile, tmplenv)
+        keep = ((incremental or (content is None and self.installMode!='link'))
+                and self.isUpToDate(srcfile, tgtfile, content))
+        if keep:
+            logging.debug('keeping unchanged file %s', tgtfile)
+            stats.count('files unchanged')
+        return InstallStep(self.dstfile, srcfile, self.installMode, role, self.module.name,
+                           self.module.modulefile, content, 'keep' if keep else 'install')
 
 
 
@@ -128,7 +619,15 @@ class Module:
                    used to resolve relative source files.
         dstdir     can be used to modify the destination path.
         files      a dictionary from role (e.g. incfiles, kernelfiles) to list(ModFile).
+
+    The tags are interned. The provides include the module's files after
+    finish(), the requires the scanned includes. Their bitsets in the
+    tagTable are derived on first use.
     """
+    __slots__ = ('name', 'modulefile', 'moduledir', 'dstdir', 'files', '_requires',
+                 '_provides', 'modules', 'copyfiles', 'vars', 'noauto', 'patterns',
+                 '_requiredFiles', '_requiresBits', '_providesBits')
+    derived = ('_requiredFiles', '_requiresBits', '_providesBits')
 
     def __init__(self, name, modulefile):
         self.name = name
@@ -136,37 +635,91 @@ class Module:
         self.moduledir = os.path.dirname(self.modulefile)
         self.dstdir = ""
         self.files = dict()
-        self._requires = set()
-        self._provides = set()
-        self.modules = set()
-        self.copyfiles = set()
+        self._requires = frozenset()
+        self._provides = frozenset()
+        self.modules = frozenset()
+        self.copyfiles = frozenset()
         self.vars = dict() # all unknown fields from the configuration
-        self.providedFiles = set()
-        self.requiredFiles = set()
         self.noauto = False
+        self.patterns = frozenset() # all file patterns, used to validate cached modules
+        self.forgetIncludes()
 
     def __repr__(self): return self.name
 
+    def __getstate__(self):
+        # include scans are cached separately and the bitsets are only valid in this process
+        return dict((k, getattr(self, k)) for k in self.__slots__ if k not in self.derived)
+
+    def __setstate__(self, state):
+        for k, v in state.items(): setattr(self, k, v)
+        self.forgetIncludes()
+
+    def forgetIncludes(self):
+        """drop the scanned includes and everything derived from them."""
+        self._requiredFiles = None # scanned lazily, see requiredFiles
+        self._requiresBits = None
+        self._providesBits = None
+
     def addFiles(self, role, names):
         if role not in self.files: self.files[role] = list()
         self.files[role] += [ModFile(self, name) for name in names]
 
+    @property
+    def providedFiles(self):
+        return frozenset(m.dstfile for role in self.files for m in self.files[role])
+
+    @property
+    def requiredFiles(self):
+        """the set of files included by the module's files but not provided by itself.
+        The source files are scanned on first access only."""
+        if self._requiredFiles is None:
+            with stats.phase('scan includes', trace=False):
+                known = self.knownFiles()
+                requiredFiles = set()
+                for role in self.files:
+                    for m in self.files[role]:
+                        requiredFiles.update(m.dependencies(known))
+                requiredFiles.difference_update(known.values())
+                self._requiredFiles = frozenset(sys.intern(f) for f in requiredFiles)
+        return self._requiredFiles
+
+    def knownFiles(self):
+        """a dictionary from the normalized source names of the module's files
+        to their destination files, used to resolve local includes."""
+        return dict((os.path.normpath(m.srcname), m.dstfile)
+                    for role in self.files for m in self.files[role])
+
+    @property
+    def declaredRequires(self): return self._requires
+
     @property
     def requires(self): return self._requires | self.requiredFiles
-    def addRequires(self, s): self._requires.update(s)
+    def addRequires(self, s):
+        self._requires = self._requires.union(sys.intern(t) for t in s)
+        self._requiresBits = None
+
+    @property
+    def provides(self): return self._provides
+    def addProvides(self, s):
+        self._provides = self._provides.union(sys.intern(t) for t in s)
+        self._providesBits = None
 
     @property
-    def provides(self): return self._provides | self.providedFiles
-    def addProvides(self, s): self._provides.update(s)
+    def requiresBits(self):
+        if self._requiresBits is None: self._requiresBits = tagTable.bits(self.requires)
+        return self._requiresBits
+
+    @property
+    def providesBits(self):
+        if self._providesBits is None: self._providesBits = tagTable.bits(self.provides)
+        return self._providesBits
 
     def finish(self):
         """finish the initialization of the module after all fields are set."""
         for role in self.files:
             for m in self.files[role]:
-                self.providedFiles.add(m.dstfile)
-                self.requiredFiles.update(m.dependencies)
                 if m.srcname in self.copyfiles: m.installMode = 'copy'
-        self.requiredFiles -= self.providedFiles
+        self.addProvides(self.providedFiles)
 
 
 class ModuleDB:
@@ -174,7 +727,10 @@ class ModuleDB:
     def __init__(self):
         self.modules = dict()
         self.provides = dict()
-        self.requires = dict()
+        self.noautoProvides = dict() # tag -> set of noauto modules providing it
+        self.providable = 0 # bitset of the tags in provides
+        self.conflicts = dict() # module -> dict of conflicting module -> set of tags
+        self._requires = None
 
     def addModule(self, mod):
         """Add a module to the database and extend the dependency tables."""
@@ -188,17 +744,52 @@ class ModuleDB:
 
         logging.debug('loaded %s from %s', mod.name, mod.modulefile)
         self.modules[mod.name] = mod
+        self._addConflicts(mod)
 
         # this module can be loaded automatically to solve following depedencies
         if not mod.noauto:
             for tag in mod.provides:
                 if tag not in self.provides: self.provides[tag] = set()
                 self.provides[tag].add(mod)
-
+            self.providable |= tagTable.bits(mod.provides) # most modules are never candidates
+        else:
+            for tag in mod.provides:
+                if tag not in self.noautoProvides: self.noautoProvides[tag] = set()
+                self.noautoProvides[tag].add(mod)
+
+    def _addConflicts(self, mod):
+        # conflicts are found through the provides table, hence noauto modules
+        # see their conflicts with other modules but not the other way round
+        def add(src, dst, tag):
+            if dst not in self.conflicts[src]: self.conflicts[src][dst] = set()
+            self.conflicts[src][dst].add(tag)
+        self.conflicts[mod] = dict()
+        for tag in mod.provides:
+            for dst in self.getProvides(tag):
+                add(mod, dst, tag)
+                if not mod.noauto: add(dst, mod, tag)
+            if not mod.noauto:
+                for dst in self.noautoProvides.get(tag, ()): add(dst, mod, tag)
+
+        if self._requires is not None: self._addRequires(mod)
+
+    def _addRequires(self, mod):
         # this module requires following dependencies in order to be useable
         for tag in mod.requires:
-            if tag not in self.requires: self.requires[tag] = set()
-            self.requires[tag].add(mod)
+            if tag not in self._requires: self._requires[tag] = set()
+            self._requires[tag].add(mod)
+
+    @property
+    def requires(self):
+        """a dictionary from tag to the set of modules that require it.
+        Built on first use because it needs the include dependencies of all modules."""
+        if self._requires is None:
+            includeScanner.prefetch([mf.srcfile for mod in self.modules.values()
+                                     for role in mod.files for mf in mod.files[role]
+                                     if mf.isScanned])
+            self._requires = dict()
+            for mod in self.modules.values(): self._addRequires(mod)
+        return self._requires
 
     def __getitem__(self,index):
         return self.modules[index]
@@ -213,11 +804,13 @@ class ModuleDB:
         return self.provides[tag]
 
     def isResolvable(self, mod, provided):
-        """ Test whether there is a chance that the dependencies of a module are resolvable. """
-        for req in mod.requires:
-            if not (req in provided or len(self.getProvides(req))):
-                logging.debug('Ignoring module %s because of unresolvable dependency on %s', mod.name, req)
-                return False
+        """ Test whether there is a chance that the dependencies of a module are resolvable.
+        provided is the bitset of the already provided tags. """
+        missing = mod.requiresBits & ~(provided | self.providable)
+        if missing:
+            logging.debug('Ignoring module %s because of unresolvable dependency on %s',
+                          mod.name, tagTable.decode(missing)[0])
+            return False
         return True
 
     def getResolvableProvides(self, tag, provided):
@@ -243,8 +836,10 @@ class ModuleDB:
         return dstmods
 
     def getConflictingModules(self, mod):
-        """inefficient method to find all modules that are in conflict with the given one.
-        Returns a dictionary mapping modules to the conflicting tags."""
+        """find all modules that are in conflict with the given one.
+        Returns a dictionary mapping modules to the conflicting tags, which is
+        served from the conflict index and must not be modified."""
+        if mod in self.conflicts: return self.conflicts[mod]
         dstmods = dict()
         for prov in mod.provides:
             for dst in self.getProvides(prov):
@@ -253,22 +848,324 @@ class ModuleDB:
                 dstmods[dst].add(prov)
         return dstmods
 
+    def dependencies(self, mod):
+        """Return the set of other modules that can satisfy a requirement of the
+        module, including noauto modules, or that it pulls in through 'modules'."""
+        deps = set()
+        for tag in mod.requires:
+            deps.update(self.getProvides(tag))
+            deps.update(self.noautoProvides.get(tag, ()))
+        deps.update(self.modules[n] for n in mod.modules if n in self.modules)
+        deps.discard(mod)
+        return deps
+
+    def dependencyCycles(self):
+        """Return the strongly connected components of the dependency graph that
+        contain more than one module, each as a list of modules sorted by name.
+        The graph is built once and traversed by an iterative Tarjan search,
+        hence the time is linear in the number of modules and dependencies."""
+        byName = lambda m: m.name
+        succ = dict((mod, sorted(self.dependencies(mod), key=byName)) for mod in self.getModules())
+        index = dict()
+        low = dict()
+        stack = list()
+        onStack = set()
+        cycles = list()
+        for root in sorted(succ, key=byName):
+            if root in index: continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(succ[root]))]
+            while work:
+                mod, edges = work[-1]
+                for dep in edges:
+                    if dep not in index:
+                        index[dep] = low[dep] = len(index)
+                        stack.append(dep)
+                        onStack.add(dep)
+                        work.append((dep, iter(succ[dep])))
+                        break
+                    elif dep in onStack:
+                        low[mod] = min(low[mod], index[dep])
+                else:
+                    work.pop()
+                    if work: low[work[-1][0]] = min(low[work[-1][0]], low[mod])
+                    if low[mod] == index[mod]:
+                        scc = list()
+                        while True:
+                            dep = stack.pop()
+                            onStack.discard(dep)
+                            scc.append(dep)
+                            if dep is mod: break
+                        if len(scc) > 1: cycles.append(sorted(scc, key=byName))
+        return cycles
+
+    def shortestCycle(self, scc):
+        """Return a shortest dependency cycle through the first module of a
+        strongly connected component as list of modules, found by breadth-first search."""
+        first = scc[0]
+        members = set(scc)
+        parent = {first: None}
+        work = collections.deque([first])
+        while work:
+            mod = work.popleft()
+            for dep in sorted(self.dependencies(mod) & members, key=lambda m: m.name):
+                if dep is first:
+                    path = list()
+                    while mod is not None:
+                        path.append(mod)
+                        mod = parent[mod]
+                    return path[::-1] + [first]
+                if dep not in parent:
+                    parent[dep] = mod
+                    work.append(dep)
+        return scc
+
     def checkConsistency(self):
-        for mod in self.getModules():
-            includes = mod.requiredFiles
-            dups = mod.requires & includes # without required files!
+        """report redundant requires, tags that no module provides and dependency cycles."""
+        requires = self.requires # scans the includes of all modules first
+        for mod in sorted(self.getModules(), key=lambda m: m.name):
+            # requires that are found by the include scan or provided by the module itself
+            dups = mod.declaredRequires & (mod.requiredFiles | mod.provides)
             if dups:
                 logging.warning('Module %s(%s) contains unnecessary requires: %s',
-                                mod.name, mod.modulefile, str(dups))
+                                mod.name, mod.modulefile, sorted(dups))
+
+        for tag in sorted(requires):
+            if tag in self.provides or tag in self.noautoProvides: continue
+            names = sorted(m.name+'('+m.modulefile+')' for m in requires[tag])
+            logging.info('Tag %s required by %s not provided by any module', tag, str(names))
+
+        for scc in self.dependencyCycles():
+            logging.warning('dependency cycle between %d modules %s, e.g. %s', len(scc),
+                            ', '.join(m.name for m in scc),
+                            ' -> '.join(m.name for m in self.shortestCycle(scc)))
+
+
+
+class SatSolver:
+    """a small CDCL SAT solver for the dependency resolution.
+
+    Variables are numbered from 1, a literal is a variable or its negation.
+    The solver uses two watched literals per clause, first-UIP clause learning
+    with non-chronological backjumping, activity-based branching and restarts.
+    Unassigned variables are tried as false first, which prefers small selections.
+    Variables and clauses can be added between calls of solve in order to refine
+    the solution.
+    """
+
+    def __init__(self, nvars):
+        self.nvars = nvars
+        self.clauses = list()
+        self.watches = dict() # literal -> list of clause indices watching it
+        self.assign = [0] * (nvars+1) # 1 true, -1 false, 0 unassigned
+        self.level = [0] * (nvars+1)
+        self.reason = [None] * (nvars+1)
+        self.phase = [-1] * (nvars+1)
+        self.activity = [0.0] * (nvars+1)
+        self.bump = 1.0
+        self.heap = [(0.0, v) for v in range(1, nvars+1)]
+        self.trail = list()
+        self.trailLim = list()
+        self.qhead = 0
+        self.ok = True
+        self.conflicts = 0
+        self.decisions = 0
+        self.propagations = 0
+
+    def newVar(self):
+        self.nvars += 1
+        for a, init in ((self.assign, 0), (self.level, 0), (self.reason, None),
+                        (self.phase, -1), (self.activity, 0.0)):
+            a.append(init)
+        heapq.heappush(self.heap, (0.0, self.nvars))
+        return self.nvars
+
+    def addCounter(self, lits, k):
+        """add a sequential counter over the literals with auxiliary variables.
+        Returns a list of k literals, the j-th is forced true if at least j+1
+        of the literals are true. Adding their negation bounds the count."""
+        s = list()
+        for i, lit in enumerate(lits):
+            s.append([self.newVar() for j in range(k)])
+            self.addClause([-lit, s[i][0]])
+            if i == 0: continue
+            for j in range(k):
+                self.addClause([-s[i-1][j], s[i][j]])
+                if j > 0: self.addClause([-lit, -s[i-1][j-1], s[i][j]])
+        return s[-1]
+
+    def addAtMost(self, lits, k):
+        """add clauses that allow at most k of the literals to be true."""
+        if k >= len(lits): return
+        self.addClause([-self.addCounter(lits, k+1)[k]])
+
+    def value(self, lit):
+        return self.assign[lit] if lit > 0 else -self.assign[-lit]
+
+    def addClause(self, lits):
+        """add a clause, must be called when no decisions are pending."""
+        self.backtrack(0)
+        lits = list(set(lits))
+        if any(-l in lits for l in lits): return # always true
+        lits = [l for l in lits if self.value(l) != -1]
+        if any(self.value(l) == 1 for l in lits): return
+        if not lits:
+            self.ok = False
+        elif len(lits) == 1:
+            self.enqueue(lits[0], None)
+            if self.propagate() is not None: self.ok = False
+        else:
+            self.attach(lits)
+
+    def attach(self, lits):
+        idx = len(self.clauses)
+        self.clauses.append(lits)
+        self.watches.setdefault(lits[0], list()).append(idx)
+        self.watches.setdefault(lits[1], list()).append(idx)
+        return idx
+
+    def enqueue(self, lit, reason):
+        v = abs(lit)
+        self.assign[v] = 1 if lit > 0 else -1
+        self.level[v] = len(self.trailLim)
+        self.reason[v] = reason
+        self.trail.append(lit)
+
+    def propagate(self):
+        """Return the index of a conflicting clause or None."""
+        while self.qhead < len(self.trail):
+            falselit = -self.trail[self.qhead]
+            self.qhead += 1
+            self.propagations += 1
+            ws = self.watches.get(falselit, [])
+            kept = list()
+            for i, ci in enumerate(ws):
+                c = self.clauses[ci]
+                if c[0] == falselit: c[0], c[1] = c[1], c[0]
+                if self.value(c[0]) == 1:
+                    kept.append(ci)
+                    continue
+                for k in range(2, len(c)):
+                    if self.value(c[k]) != -1:
+                        c[1], c[k] = c[k], c[1]
+                        self.watches.setdefault(c[1], list()).append(ci)
+                        break
+                else:
+                    kept.append(ci)
+                    if self.value(c[0]) == -1:
+                        kept.extend(ws[i+1:])
+                        self.watches[falselit] = kept
+                        return ci
+                    self.enqueue(c[0], ci)
+            self.watches[falselit] = kept
+        return None
+
+    def analyze(self, confl):
+        """derive the first-UIP clause from a conflict.
+        Returns the learnt clause with the asserting literal first and the backjump level."""
+        learnt = [None]
+        seen = set()
+        counter = 0
+        p = None
+        idx = len(self.trail) - 1
+        curlevel = len(self.trailLim)
+        lits = self.clauses[confl]
+        while True:
+            for q in (lits if p is None else lits[1:]):
+                v = abs(q)
+                if v in seen or self.level[v] == 0: continue
+                seen.add(v)
+                self.bumpActivity(v)
+                if self.level[v] == curlevel: counter += 1
+                else: learnt.append(q)
+            while abs(self.trail[idx]) not in seen: idx -= 1
+            p = self.trail[idx]
+            idx -= 1
+            counter -= 1
+            if counter == 0: break
+            lits = self.clauses[self.reason[abs(p)]]
+        learnt[0] = -p
+        btlevel = 0
+        if len(learnt) > 1:
+            k = max(range(1, len(learnt)), key=lambda i: self.level[abs(learnt[i])])
+            learnt[1], learnt[k] = learnt[k], learnt[1]
+            btlevel = self.level[abs(learnt[1])]
+        return learnt, btlevel
+
+    def bumpActivity(self, v):
+        self.activity[v] += self.bump
+        if self.activity[v] > 1e100:
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.bump *= 1e-100
+            self.heap = [(-self.activity[u], u) for u in range(1, self.nvars+1)]
+            heapq.heapify(self.heap)
+        else:
+            heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def backtrack(self, level):
+        if len(self.trailLim) <= level: return
+        start = self.trailLim[level]
+        for lit in self.trail[start:]:
+            v = abs(lit)
+            self.phase[v] = self.assign[v]
+            self.assign[v] = 0
+            self.reason[v] = None
+            heapq.heappush(self.heap, (-self.activity[v], v))
+        del self.trail[start:]
+        del self.trailLim[level:]
+        self.qhead = len(self.trail)
+
+    def pickBranchVar(self):
+        while self.heap:
+            act, v = heapq.heappop(self.heap)
+            if self.assign[v] == 0: return v
+        return None
+
+    def solve(self, deadline=None):
+        """search for a model.
+        Returns True if satisfiable, False if not, and None if the deadline passed."""
+        if not self.ok: return False
+        self.backtrack(0)
+        if self.propagate() is not None:
+            self.ok = False
+            return False
+        restartLimit = 100
+        conflictsSinceRestart = 0
+        while True:
+            confl = self.propagate()
+            if confl is not None:
+                self.conflicts += 1
+                conflictsSinceRestart += 1
+                if not self.trailLim:
+                    self.ok = False
+                    return False
+                learnt, btlevel = self.analyze(confl)
+                self.backtrack(btlevel)
+                if len(learnt) == 1:
+                    self.enqueue(learnt[0], None)
+                else:
+                    self.enqueue(learnt[0], self.attach(learnt))
+                self.bump /= 0.95
+            else:
+                if conflictsSinceRestart >= restartLimit:
+                    conflictsSinceRestart = 0
+                    restartLimit = int(restartLimit * 1.5)
+                    self.backtrack(0)
+                    continue
+                v = self.pickBranchVar()
+                if v is None: return True
+                if deadline is not None and time.time() > deadline:
+                    self.backtrack(0)
+                    return None
+                self.decisions += 1
+                self.trailLim.append(len(self.trail))
+                self.enqueue(v if self.phase[v] > 0 else -v, None)
 
-        requires = set(self.requires.keys())
-        provides = set(self.provides.keys())
-        unsat = requires - provides
-        if unsat != set():
-            for require in unsat:
-                names = [m.name+'('+m.modulefile+')' for m in self.getRequires(require)]
-                logging.info('Tag %s required by %s not provided by any module',
-                             require, str(names))
+    def model(self):
+        """Return the set of variables that are true in the current model."""
+        return set(v for v in range(1, self.nvars+1) if self.assign[v] == 1)
 
 
 
@@ -279,6 +1176,10 @@ class Configuration:
         self.requires = set()
         self.modules = set()
         self.dstdir = '.'
+        self.database = 'toml' # 'sqlite' writes the indexed mcconf.sqlite as well
+
+        self.providesBits = 0 # bitsets of provides and requires, see processModules
+        self.requiresBits = 0
 
         self.acceptedMods = set() # set of selected module objects
         self.files = dict() # dict role -> dict dstfile -> ModFile
@@ -299,9 +1200,8 @@ class Configuration:
             if mod in self.acceptedMods: continue
             # 3) error if conflict with previously selected module
             # conflict if one of the provides is already provided
-            conflicts = self.provides & mod.provides
-            if conflicts:
-                for tag in conflicts:
+            if self.providesBits & mod.providesBits:
+                for tag in tagTable.decode(self.providesBits & mod.providesBits):
                     conflictMods = self.modDB.getProvides(tag) & self.acceptedMods
                     cnames = [m.name for m in conflictMods]
                     logging.warning("requested module %s tag %s conflicts with %s",
@@ -319,6 +1219,8 @@ class Configuration:
             pendingMods |= mod.modules
             self.requires |= mod.requires
             self.provides |= mod.provides
+            self.requiresBits |= mod.requiresBits
+            self.providesBits |= mod.providesBits
             for role in mod.files:
                 for mf in mod.files[role]:
                     if mf.dstfile in self.allfiles:
@@ -329,42 +1231,151 @@ class Configuration:
                     self.allfiles[mf.dstfile] = mf
 
     def getMissingRequires(self):
-        return self.requires - self.provides
+        return set(tagTable.decode(self.missingBits()))
+
+    def variant(self, modules=()):
+        """Return a new unresolved Configuration with the same settings and
+        ModuleDB that selects the given module names in addition."""
+        config = Configuration(self.vars['config_file'])
+        config.moduledirs = list(self.moduledirs)
+        config.provides = set(self.provides)
+        config.requires = set(self.requires)
+        config.modules = self.modules | set(modules)
+        config.dstdir = self.dstdir
+        config.database = self.database
+        config.vars = dict(self.vars)
+        config.modDB = self.modDB
+        return config
 
-    def processModules(self, resolveDeps):
+    def enumerateVariants(self, alternatives):
+        """enumerate the cross product of alternative providers for some tags.
+        alternatives is a list of (tag, list of module names). The choices are
+        made tag by tag in this order, together with the modules they pull in
+        through 'modules'. A branch is pruned as soon as a chosen module conflicts
+        with the selected modules or requires a tag that no module provides.
+        Returns a list of (choices, reason) in the order of enumeration, where
+        choices is a list of (tag, module name) and reason is None for complete
+        variants that remain to be resolved. A pruned prefix stands for all its
+        completions."""
+        base = self.variant()
+        base.requiresBits = tagTable.bits(base.requires)
+        base.providesBits = tagTable.bits(base.provides)
+        base.applyModules(base.modules)
+        results = list()
+
+        def closure(name):
+            """the modules pulled in by selecting a module, including itself."""
+            found = dict()
+            pending = [name]
+            while pending:
+                name = pending.pop()
+                if name in found or not self.modDB.has(name): continue
+                found[name] = self.modDB[name]
+                pending.extend(found[name].modules)
+            return found.values()
+
+        # bitsets of the tags that the choices from each depth on can provide
+        possible = [0] * (len(alternatives)+1)
+        for depth in range(len(alternatives)-1, -1, -1):
+            possible[depth] = possible[depth+1]
+            for name in alternatives[depth][1]:
+                for mod in closure(name): possible[depth] |= mod.providesBits
+
+        def choose(name, selected, provides, requires, later):
+            """Return the new state after selecting a module and the modules it
+            pulls in, or a string that explains why the branch is pruned.
+            later is the bitset of the tags that later choices may provide."""
+            pending = [name]
+            selected = set(selected)
+            while pending:
+                name = pending.pop()
+                if not self.modDB.has(name): return 'module %s not found' % name
+                mod = self.modDB[name]
+                if mod in selected: continue
+                if provides & mod.providesBits:
+                    return '%s conflicts on %s' % (name, ', '.join(tagTable.decode(provides & mod.providesBits)))
+                selected.add(mod)
+                provides |= mod.providesBits
+                requires |= mod.requiresBits
+                pending.extend(sorted(mod.modules, reverse=True))
+            for mod in selected:
+                missing = mod.requiresBits & ~(provides | self.modDB.providable | later)
+                if missing:
+                    return '%s requires unprovided %s' % (mod.name, ', '.join(tagTable.decode(missing)))
+            return selected, provides, requires
+
+        def search(depth, choices, state):
+            if depth == len(alternatives):
+                results.append((choices, None))
+                return
+            tag, names = alternatives[depth]
+            for name in names:
+                selected, provides, requires = state
+                if self.modDB.has(name) and self.modDB[name] in selected:
+                    search(depth+1, choices+[(tag, name)], state)
+                    continue
+                if tag in tagTable.ids and provides >> tagTable.ids[tag] & 1:
+                    nextState = 'tag %s is provided already' % tag
+                else:
+                    nextState = choose(name, selected, provides, requires, possible[depth+1])
+                if isinstance(nextState, str):
+                    stats.count('variants pruned')
+                    results.append((choices+[(tag, name)], nextState))
+                else:
+                    search(depth+1, choices+[(tag, name)], nextState)
+
+        search(0, [], (frozenset(base.acceptedMods), base.providesBits, base.requiresBits))
+        return results
+
+    def missingBits(self):
+        return self.requiresBits & ~self.providesBits
+
+    def processModules(self, resolveDeps, solver='greedy', budget=10.0):
         '''if resolveDeps is true, this method tries to resolve missing dependencies
-        by including additional modules from the module DB'''
+        by including additional modules from the module DB. The solver is either
+        'greedy' or 'sat', the latter falls back to greedy if it finds no solution.
+        Returns the set of additionally selected modules.'''
+        self.requiresBits |= tagTable.bits(self.requires)
+        self.providesBits |= tagTable.bits(self.provides)
         self.applyModules(self.modules)
 
+        additionalMods = set()
         if resolveDeps:
-            additionalMods = self.resolveDependencies()
+            additionalMods = None
+            if solver == 'sat':
+                additionalMods = self.resolveDependenciesSat(budget)
+                if additionalMods is None:
+                    logging.warning('falling back to the greedy dependency resolution')
+            if additionalMods is None:
+                additionalMods = self.resolveDependencies()
             names = ", ".join(sorted([m.name for m in additionalMods]))
             logging.info('added modules to resolve dependencies: %s', names)
 
         missingRequires = self.getMissingRequires()
         for tag in missingRequires:
-            reqMods = self.modDB.getRequires(tag) & self.acceptedMods
-            req = [m.name for m in reqMods]
+            req = [m.name for m in self.acceptedMods if tag in m.requires]
             prov = [m.name for m in self.modDB.getProvides(tag)]
             logging.warning('unresolved dependency %s required by [%s] provided by [%s]',
                             tag, ', '.join(req), ', '.join(prov))
+        return additionalMods
 
     def resolveDependencies(self):
         additionalMods = set()
-        missingRequires = self.getMissingRequires()
+        missingRequires = tagTable.decode(self.missingBits())
         count = 1
         while count:
             count = 0
+            stats.count('resolver iterations')
             for tag in missingRequires:
-                solutions = self.modDB.getResolvableProvides(tag, self.provides)
+                solutions = self.modDB.getResolvableProvides(tag, self.providesBits)
 
                 # 1) ignore modules that have conflicts already
                 good_solutions = set()
                 for mod in solutions:
-                    conflicts = self.provides & mod.provides
+                    conflicts = self.providesBits & mod.providesBits
                     if conflicts:
                         logging.debug('Ignoring module %s for dependency %s because of conflicts with already selected modules providing %s',
-                            mod.name, tag, [str(c) for c in conflicts])
+                            mod.name, tag, tagTable.decode(conflicts))
                     else:
                         good_solutions.add(mod)
 
@@ -384,54 +1395,453 @@ class Configuration:
                 additionalMods.add(mod)
                 count += 1
                 self.applyModules(set([mod.name]))
-                missingRequires = self.getMissingRequires()
+                missingRequires = tagTable.decode(self.missingBits())
                 break
 
         # return set of additionally selected modules
         return additionalMods
 
+    def resolveDependenciesSat(self, budget=10.0):
+        '''select a smallest set of additional modules that satisfies all
+        resolvable dependencies without conflicts by means of the SatSolver.
+        Returns the set of additionally selected modules or None if no
+        consistent selection was found within the time budget in seconds.'''
+        started = time.time()
+        deadline = started + budget
+        byName = lambda m: m.name
+
+        # 1) collect all modules that might contribute to a solution
+        missing = self.getMissingRequires()
+        candidates = list()
+        var = dict()
+        work = sorted(missing)
+        seenTags = set(work)
+        while work:
+            tag = work.pop()
+            pending = sorted(self.modDB.getProvides(tag), key=byName, reverse=True)
+            while pending:
+                mod = pending.pop()
+                if mod in self.acceptedMods or mod in var: continue
+                candidates.append(mod)
+                var[mod] = len(candidates)
+                pending.extend(self.modDB[n] for n in sorted(mod.modules) if self.modDB.has(n))
+                for req in sorted(tagTable.decode(mod.requiresBits & ~self.providesBits)):
+                    if req not in seenTags:
+                        seenTags.add(req)
+                        work.append(req)
+
+        providers = dict()
+        includers = dict()
+        for mod in candidates:
+            for tag in mod.provides:
+                providers.setdefault(tag, list()).append(var[mod])
+            for name in mod.modules:
+                includers.setdefault(name, list()).append(var[mod])
+
+        # 2) encode dependencies, inclusions and conflicts as clauses
+        clauses = list()
+        for mod in candidates:
+            x = var[mod]
+            if mod.providesBits & self.providesBits: clauses.append([-x])
+            for req in tagTable.decode(mod.requiresBits & ~self.providesBits):
+                clauses.append([-x] + providers.get(req, []))
+            for name in mod.modules:
+                if not self.modDB.has(name): clauses.append([-x])
+                elif self.modDB[name] not in self.acceptedMods:
+                    clauses.append([-x, var[self.modDB[name]]])
+            if mod.noauto: clauses.append([-x] + includers.get(mod.name, []))
+        uncovered = set() # missing tags that no consistent selection provides
+
+        def encode(soft):
+            """Return a solver for the clauses and the coverage of the missing tags.
+            If soft, a tag may stay uncovered if its relaxation variable is true,
+            these are returned as dictionary from tag to variable."""
+            solver = SatSolver(len(candidates))
+            for clause in clauses: solver.addClause(clause)
+            for tag in providers:
+                xs = providers[tag]
+                if len(xs) <= 6: # pairwise exclusion
+                    for i in range(len(xs)):
+                        for k in range(i+1, len(xs)): solver.addClause([-xs[i], -xs[k]])
+                else:
+                    solver.addAtMost(xs, 1)
+            relax = dict()
+            for tag in sorted(missing):
+                if tag not in providers or tag in uncovered: continue
+                if soft:
+                    # branch on the relaxations first, so they stay false unless forced
+                    relax[tag] = solver.newVar()
+                    solver.bumpActivity(relax[tag])
+                solver.addClause(list(providers[tag]) + ([relax[tag]] if soft else []))
+            return solver, relax
+
+        def shrink(solver, lits, model):
+            """tighten a counter over the literals that are not already decided
+            without search until no model with fewer true literals remains.
+            Returns the last model, the result of the last solve and the rounds."""
+            solver.backtrack(0)
+            free = [x for x in lits if solver.value(x) == 0]
+            bound = len(model.intersection(free))
+            result = True
+            rounds = 0
+            if bound: limit = solver.addCounter(free, bound)
+            while bound:
+                solver.addClause([-limit[bound-1]])
+                rounds += 1
+                result = solver.solve(deadline)
+                if not result: break
+                model = solver.model()
+                bound = len(model.intersection(free))
+            return model, result, rounds
+
+        # 3) solve, first leave as few missing tags uncovered as possible,
+        # then shrink the number of selected modules until it is minimal
+        solver, relax = encode(True)
+        result = solver.solve(deadline)
+        rounds = 0
+        best = None
+        minimal = True
+        if result:
+            model = solver.model()
+            if model.intersection(relax.values()):
+                model, result, rounds = shrink(solver, sorted(relax.values()), model)
+                minimal = result is not None
+                uncovered = set(tag for tag in relax if relax[tag] in model)
+                if uncovered:
+                    logging.info('sat solver: no consistent selection provides %s',
+                                 ', '.join(sorted(uncovered)))
+                solver, relax = encode(False)
+                result = solver.solve(deadline)
+                model = solver.model() if result else None
+            else:
+                for x in relax.values(): solver.addClause([-x])
+            if model is not None:
+                model, result, n = shrink(solver, range(1, len(candidates)+1), model)
+                rounds += n
+                best = set(x for x in model if x <= len(candidates))
+
+        stats.count('sat decisions', solver.decisions)
+        stats.count('sat conflicts', solver.conflicts)
+        logging.info('sat solver: %d candidate modules, %d variables, %d clauses, '
+                     '%d decisions, %d conflicts, %d propagations, %d minimization rounds, %.3fs',
+                     len(candidates), solver.nvars, len(solver.clauses), solver.decisions,
+                     solver.conflicts, solver.propagations, rounds, time.time()-started)
+        if best is None:
+            if result is None:
+                logging.warning('sat solver exceeded the time budget of %gs', budget)
+            else:
+                logging.warning('sat solver found no consistent selection of modules')
+            return None
+        if result is None or not minimal:
+            logging.info('sat solver exceeded the time budget, solution may not be minimal')
+
+        additionalMods = set(mod for mod in candidates if var[mod] in best)
+        for mod in sorted(additionalMods, key=byName):
+            logging.debug('Selecting module %s', mod.name)
+        self.applyModules(set(mod.name for mod in additionalMods))
+        return additionalMods
+
     def checkConsistency(self):
-        selected = set([self.modDB[n] for n in self.modules])
+        """report selected modules that the dependency resolution would add anyway."""
+        selected = set([self.modDB[n] for n in self.modules if self.modDB.has(n)])
+        # bitsets of the tags required by at least one and by at least two selected modules
+        needed = neededTwice = 0
+        for mod in selected:
+            neededTwice |= needed & mod.requiresBits
+            needed |= mod.requiresBits
         removable = set()
         for mod in selected:
             # 1) modules with conflicts should be selected
-            conflictMods = self.modDB.getConflictingModules(mod)
-            if conflictMods: continue
-            # 2) modules that do not satisfy any dependency should be selected
-            providesAnything = False
-            for tag in mod.provides:
-                if self.modDB.getRequires(tag) & selected:
-                    providesAnything = True
-            if not providesAnything: continue
+            if self.modDB.getConflictingModules(mod): continue
+            # 2) modules that do not satisfy a dependency of another selected module should be selected
+            neededByOthers = neededTwice | (needed & ~mod.requiresBits)
+            if not mod.providesBits & neededByOthers: continue
             # remember all other modules
             removable.add(mod)
         if removable:
             logging.info("following modules could be resolved automatically: %s",
-                         str(removable))
+                         ', '.join(sorted(m.name for m in removable)))
+
+    def includeGraph(self):
+        """Return a dictionary from destination file to the set of destination
+        files of the configuration that include it."""
+        includers = dict()
+        for mod in self.acceptedMods:
+            known = mod.knownFiles()
+            for role in mod.files:
+                for mf in mod.files[role]:
+                    if self.allfiles.get(mf.dstfile) is not mf: continue
+                    for inc in mf.dependencies(known):
+                        if inc in self.allfiles: includers.setdefault(inc, set()).add(mf.dstfile)
+        return includers
+
+    def affectedFiles(self, changed):
+        """Return the set of destination files whose source is in the set of
+        changed absolute paths or includes such a file, directly or transitively.
+        A changed module file affects all files of its modules, a changed
+        configuration file all files."""
+        if self.vars['config_file'] in changed: return set(self.allfiles)
+        work = [dst for dst, mf in self.allfiles.items()
+                if os.path.abspath(mf.srcfile) in changed or mf.module.modulefile in changed]
+        affected = set(work)
+        includers = self.includeGraph()
+        while work:
+            for dst in includers.get(work.pop(), ()):
+                if dst not in affected:
+                    affected.add(dst)
+                    work.append(dst)
+        return affected
+
+    def previousFiles(self):
+        """Return the set of destination files listed in the mcconf.sqlite or
+        mcconf.db of a previous run."""
+        sqlfile = os.path.join(self.dstdir, 'mcconf.sqlite')
+        if os.path.isfile(sqlfile):
+            import sqlite3
+            try:
+                db = sqlite3.connect(sqlfile)
+                try:
+                    return set(row[0] for row in db.execute('SELECT dst FROM files'))
+                finally:
+                    db.close()
+            except sqlite3.Error as e:
+                logging.warning('ignoring unreadable manifest %s: %s', sqlfile, e)
+        dbfile = os.path.join(self.dstdir, 'mcconf.db')
+        if not os.path.isfile(dbfile): return set()
+        try:
+            with open(dbfile, 'r') as fin:
+                return set(toml.load(fin).get('files', dict()).keys())
+        except Exception as e:
+            logging.warning('ignoring unreadable manifest %s: %s', dbfile, e)
+            return set()
 
-    def install(self):
+    def templateEnv(self):
+        """returns the variables that are passed to the mako templates."""
         tmplenv = {"vars": argparse.Namespace(**self.vars), "modules": self.acceptedMods,
                    "dstdir": os.path.abspath(self.dstdir),
                    "files": self.files, "allfiles":self.allfiles,
         }
         tmplenv['replaceSuffix'] = lambda str, osuf, nsuf: str[:-len(osuf)] + nsuf
         tmplenv['relpath'] = lambda str: os.path.relpath(str, os.path.abspath(self.dstdir))
+        sortedMods = sorted(self.acceptedMods, key=lambda x:x.name)
         def tmplIncludeModules(var, ctx):
-            for mod in sorted(ctx["modules"],key=lambda x:x.name):
+            for mod in sortedMods:
                 if var in mod.vars:
                     ctx.write("#--- "+var+" from module "+mod.name+"\n")
-                    mako.template.Template(mod.vars[var], imports=['import os']).render_context(ctx)
+                    tmpl = templateCache.get(mod.vars[var], mod.name+'.'+var)
+                    tmpl.render_context(ctx)
+                    stats.count('templates rendered')
                     ctx.write("#--- end module "+mod.name+"\n\n")
             return ''
         tmplenv['includeModules'] = tmplIncludeModules
+        return tmplenv
+
+    def plan(self, incremental=False, jobs=1):
+        """Return the InstallPlan of the configuration without changing the
+        destination directory. Templates are rendered, by a pool of threads
+        if jobs > 1. In incremental mode, files listed in the previous
+        mcconf.db that are not part of the configuration anymore are to be
+        removed and unchanged files are kept."""
+        tmplenv = self.templateEnv()
+        dstdir = os.path.abspath(self.dstdir)
+        roles = dict((dst, role) for role in self.files for dst in self.files[role])
+
+        stale = list()
+        if incremental:
+            for dst in sorted(self.previousFiles() - set(self.allfiles.keys())):
+                if os.path.isabs(dst) or os.path.normpath(dst).startswith('..'): continue
+                tgtfile = os.path.join(dstdir, dst)
+                if os.path.exists(tgtfile) or os.path.islink(tgtfile): stale.append(dst)
+
+        def planFile(mf):
+            try:
+                return mf.plan(dstdir, tmplenv, incremental, roles.get(mf.dstfile, '')), None
+            except Exception as e:
+                return None, e
+        modfiles = [self.allfiles[k] for k in sorted(self.allfiles)]
+        results = mapThreads(planFile, modfiles, jobs)
+        errors = [(mf, e) for mf, (step, e) in zip(modfiles, results) if e is not None]
+        for mf, e in errors:
+            logging.error('installing file %s from module %s failed: %s', mf.dstfile, mf.module, e)
+        if errors: raise errors[0][1]
+        logging.debug('compiled %d templates, loaded %d from the template cache',
+                      templateCache.compiled, templateCache.loaded)
+        return InstallPlan(dstdir, tuple(step for step, e in results), tuple(stale),
+                           types.MappingProxyType(dict(self.vars)), self.database)
+
+    def install(self, incremental=False, jobs=1):
+        """install all files into the destination directory, see plan and InstallPlan.apply.
+        Returns the InstallPlan."""
+        plan = self.plan(incremental, jobs)
+        written, removed = plan.apply(jobs)
+        if incremental:
+            logging.info('installed %d files, kept %d unchanged files, removed %d stale files',
+                         written, len(plan.steps)-written, removed)
+        return plan
+
+
+def mapThreads(fn, items, jobs):
+    """Return the list of fn(item) for all items, computed by a pool of jobs threads."""
+    if jobs <= 1 or len(items) <= 1: return [fn(item) for item in items]
+    import multiprocessing.pool
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
+
+class InstallStep(collections.namedtuple('InstallStep', ['dstfile', 'srcfile', 'mode', 'role',
+                                                         'module', 'modulefile', 'content', 'action'])):
+    """how one file of an InstallPlan is installed.
+
+    Attributes:
+        dstfile the path of the target, relative to the destination directory.
+        srcfile the absolute path of the source file.
+        mode    the install mode (link, hardlink, copy, cinclude, mako).
+        role    the file list of the file, e.g. INCFILES.
+        module  the name of the module and modulefile the absolute path of its definition.
+        content the rendered content of generated files, otherwise None.
+        action  'install' if the target is written, 'keep' if it is up to date.
+    """
+    __slots__ = ()
 
-        if not os.path.exists(self.dstdir): os.makedirs(self.dstdir)
-        for k in self.allfiles: self.allfiles[k].install(self.dstdir, tmplenv)
+    def apply(self, tgtdir):
+        """write the target into the target directory, replacing an existing file."""
+        srcfile = self.srcfile
+        tgtfile = os.path.join(tgtdir, self.dstfile)
+        stats.count('files installed ('+self.mode+')')
+        logging.debug('installing file %s to %s mode %s from module %s',
+                      srcfile, tgtfile, self.mode, self.module)
+        if not os.path.exists(os.path.dirname(tgtfile)):
+            os.makedirs(os.path.dirname(tgtfile))
+        if os.path.exists(tgtfile) or os.path.islink(tgtfile):
+            os.unlink(tgtfile)
 
+        if self.mode=='link':
+            os.symlink(os.path.relpath(srcfile, os.path.dirname(tgtfile)), tgtfile)
+        elif self.mode=='hardlink':
+            fileCopier.link(srcfile, tgtfile)
+        elif self.content is not None:
+            with open(tgtfile, 'w') as f:
+                f.write(self.content)
+            if self.mode=='mako': shutil.copymode(srcfile, tgtfile)
+        else: # copy the file
+            fileCopier.copy(srcfile, tgtfile)
 
+class InstallPlan(collections.namedtuple('InstallPlan', ['dstdir', 'steps', 'stale', 'vars', 'database'])):
+    """the installation of a configuration, planned without touching the destination.
 
-def parseTomlModule(modulefile):
-    """parses a mcconf module file and returns a list(Module)."""
+    Attributes:
+        dstdir   the absolute destination directory.
+        steps    a tuple(InstallStep) sorted by destination file.
+        stale    a tuple of the files of a previous run that are removed,
+                 relative to the destination directory.
+        vars     a read-only mapping of the configuration vars.
+        database 'sqlite' if mcconf.sqlite is written next to mcconf.db.
+    """
+    __slots__ = ()
+
+    @property
+    def changes(self):
+        """the steps that write their target."""
+        return tuple(step for step in self.steps if step.action == 'install')
+
+    @property
+    def isNoop(self):
+        """whether applying the plan would change nothing but mcconf.sqlite."""
+        return not self.stale and not any(step.action == 'install' for step in self.steps)
+
+    def asDict(self):
+        """Return the plan as dictionary for JSON output, without the rendered content."""
+        return {'dstdir': self.dstdir, 'vars': dict(self.vars), 'database': self.database,
+                'remove': list(self.stale),
+                'files': [dict((k, v) for k, v in step._asdict().items() if k != 'content')
+                          for step in self.steps]}
+
+    def write(self, fout):
+        """write the plan as JSON, which is the output of a dry run."""
+        import json
+        json.dump(self.asDict(), fout, indent=1, sort_keys=True)
+        fout.write('\n')
+
+    def apply(self, jobs=1):
+        """remove the stale files and write all targets that are not kept.
+        With jobs > 1, the files are written by a pool of threads. All failed
+        files are reported in the order of their names and the first error is raised.
+        Returns the number of written and of removed files."""
+        removed = 0
+        for dst in self.stale:
+            tgtfile = os.path.join(self.dstdir, dst)
+            if os.path.exists(tgtfile) or os.path.islink(tgtfile):
+                logging.debug('removing stale file %s', tgtfile)
+                os.unlink(tgtfile)
+                removed += 1
+                try:
+                    os.removedirs(os.path.dirname(tgtfile))
+                except OSError:
+                    pass # directory not empty
+        dirs = set([self.dstdir])
+        dirs.update(os.path.dirname(os.path.join(self.dstdir, step.dstfile)) for step in self.steps)
+        for d in sorted(dirs):
+            if not os.path.isdir(d): os.makedirs(d)
+
+        def applyStep(step):
+            try:
+                step.apply(self.dstdir)
+                return None
+            except Exception as e:
+                return e
+        changes = self.changes
+        errors = [(step, e) for step, e in zip(changes, mapThreads(applyStep, changes, jobs))
+                  if e is not None]
+        for step, e in errors:
+            logging.error('installing file %s from module %s failed: %s', step.dstfile, step.module, e)
+        if errors: raise errors[0][1]
+
+        sqlfile = os.path.join(self.dstdir, 'mcconf.sqlite')
+        if self.database == 'sqlite':
+            self.writeDatabase(sqlfile)
+        elif os.path.exists(sqlfile):
+            os.unlink(sqlfile) # would shadow the new mcconf.db
+        return len(changes), removed
+
+    def writeDatabase(self, filename):
+        """write the file map with install mode, role and origin module of each
+        file and the vars into an SQLite database. Paths are relative to the
+        destination directory like in mcconf.db, the values of the vars are
+        JSON encoded. Files are looked up by a single query on the primary key."""
+        import sqlite3
+        import json
+        relpath = lambda path: os.path.relpath(path, self.dstdir)
+        dbvars = dict(self.vars)
+        dbvars['config_file'] = relpath(self.vars['config_file'])
+        dbvars['dest_dir'] = os.path.relpath(self.dstdir, os.path.dirname(self.vars['config_file']))
+        if 'mcconf' in dbvars: dbvars['mcconf'] = relpath(self.vars['mcconf'])
+
+        tmpfile = filename + '.tmp'
+        if os.path.exists(tmpfile): os.unlink(tmpfile)
+        db = sqlite3.connect(tmpfile)
+        try:
+            db.execute('CREATE TABLE vars (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            db.execute('CREATE TABLE files (dst TEXT PRIMARY KEY, src TEXT NOT NULL, '
+                       'mode TEXT NOT NULL, role TEXT NOT NULL, module TEXT NOT NULL, '
+                       'modulefile TEXT NOT NULL) WITHOUT ROWID')
+            db.executemany('INSERT INTO vars VALUES (?, ?)',
+                           [(k, json.dumps(dbvars[k])) for k in sorted(dbvars)])
+            db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                           [(step.dstfile, relpath(step.srcfile), step.mode, step.role,
+                             step.module, relpath(step.modulefile)) for step in self.steps])
+            db.commit()
+        finally:
+            db.close()
+        os.rename(tmpfile, filename)
+
+
+
+def parseTomlModule(modulefile, index=None):
+    """parses a mcconf module file and returns a list(Module).
+    The file patterns are resolved through the DirIndex if given."""
     modules = list()
     with open(modulefile, 'r') as f:
         content = toml.load(f)
@@ -440,11 +1850,12 @@ def parseTomlModule(modulefile):
             mod = Module(name, modulefile)
             for field in fields:
                 if field.endswith('files'):
-                    mod.addFiles(field.upper(), findFiles(mod.moduledir, fields[field]))
-                elif field == 'copy': mod.copyfiles = set(fields['copy'])
+                    mod.patterns = mod.patterns.union(fields[field])
+                    mod.addFiles(field.upper(), findFiles(mod.moduledir, fields[field], index))
+                elif field == 'copy': mod.copyfiles = frozenset(fields['copy'])
                 elif field == 'requires': mod.addRequires(fields['requires'])
                 elif field == 'provides': mod.addProvides(fields['provides'])
-                elif field == 'modules': mod.modules = set(fields['modules'])
+                elif field == 'modules': mod.modules = frozenset(fields['modules'])
                 elif field == 'dstdir': mod.dstdir = fields['dstdir']
                 elif field == 'noauto': mod.noauto = bool(fields['noauto'])
                 else: mod.vars[field] = fields[field]
@@ -453,23 +1864,157 @@ def parseTomlModule(modulefile):
             modules.append(mod)
     return modules
 
-def loadModules(moddb, basedir, paths):
+class ModuleCache:
+    """a persistent cache of parsed module files.
+
+    Each entry maps the absolute path of a module file to the list(Module)
+    parsed from it and to the fingerprints of everything the parse depended on:
+    the module file itself and the directories searched by the file patterns.
+    The memo of the includeScanner is stored alongside. Without a filename,
+    the cache is kept in memory only.
+    """
+    VERSION = 4
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = dict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename): return
+        try:
+            with open(self.filename, 'rb') as fin:
+                data = pickle.load(fin)
+            if data.get('version') == self.VERSION:
+                self.entries = data['entries']
+                includeScanner.memo = data['includes']
+        except Exception as e:
+            logging.warning('ignoring unreadable module cache %s: %s', self.filename, e)
+
+    def save(self):
+        if not self.filename or not (self.dirty or includeScanner.dirty): return
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'wb') as fout:
+            pickle.dump({'version': self.VERSION, 'entries': self.entries,
+                         'includes': includeScanner.memo},
+                        fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, self.filename)
+        self.dirty = False
+        includeScanner.dirty = False
+
+    def lookup(self, modulefile):
+        """Return the cached list(Module) or None if the entry is missing or outdated."""
+        entry = self.entries.get(modulefile)
+        if entry is not None:
+            deps, modules = entry
+            if all(statKey(path) == key for path, key in deps.items()):
+                self.hits += 1
+                for mod in modules: mod.forgetIncludes() # sources may have changed
+                return modules
+        self.misses += 1
+        return None
+
+    def store(self, modulefile, modules):
+        deps = {modulefile: statKey(modulefile)}
+        for mod in modules:
+            for d in findFileDirs(mod.moduledir, mod.patterns): deps[d] = statKey(d)
+        self.entries[modulefile] = (deps, modules)
+        self.dirty = True
+
+workerIndexes = dict() # module file -> DirIndex, set up in each worker process
+
+def initWorker(indexes):
+    global workerIndexes
+    workerIndexes = indexes
+
+def parseModuleFile(modulefile):
+    """parse a module file in a worker process.
+    Returns a list(Module) or the error message if parsing failed."""
+    try:
+        return parseTomlModule(modulefile, workerIndexes.get(modulefile))
+    except Exception as e:
+        return '%s: %s' % (type(e).__name__, e)
+
+def parseModuleDirs(paths, cache=None, jobs=1):
+    """parse all module files found in the search paths.
+    Each search path is walked only once, module discovery and the file
+    patterns of its modules are matched against the resulting DirIndex.
+    With jobs > 1, module files that are not cached are parsed by a pool of
+    worker processes.
+    Returns a list of (path, list of (modulefile, list(Module))) in the order of discovery."""
+    modulefiles = list()
+    found = list()
+    indexes = dict()
     for path in paths:
-        path = os.path.join(basedir, path)
         logging.info("searching modules in %s", path)
-        for f in findFiles(path, ["**/*.module", "**/mcconf.toml", "**/*.mcconf"]):
+        with stats.phase('discover modules'):
+            index = DirIndex(path)
+            files = list()
+            for f in sorted(findFiles(path, ["**/*.module", "**/mcconf.toml", "**/*.mcconf"], index)):
+                modulefile = os.path.abspath(os.path.join(path,f))
+                files.append(modulefile)
+                indexes.setdefault(modulefile, index)
+        modulefiles.extend(files)
+        found.append((path, files))
+    stats.count('module files', len(modulefiles))
+
+    with stats.phase('parse modules'):
+        parsed = dict()
+        if cache:
+            for modulefile in modulefiles:
+                modules = cache.lookup(modulefile)
+                if modules is not None: parsed[modulefile] = modules
+        pending = [f for f in sorted(set(modulefiles)) if f not in parsed]
+        if jobs > 1 and len(pending) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(jobs, len(pending)), initWorker,
+                                        (dict((f, indexes[f]) for f in pending),))
             try:
-                for mod in parseTomlModule(os.path.join(path,f)): moddb.addModule(mod)
+                results = pool.map(parseModuleFile, pending)
+            finally:
+                pool.close()
+                pool.join()
+            parsed.update(zip(pending, results))
+
+        for modulefile in modulefiles:
+            modules = parsed.get(modulefile)
+            try:
+                if modules is None: modules = parseTomlModule(modulefile, indexes[modulefile])
+                elif not isinstance(modules, list): raise Exception(modules)
             except:
-                logging.error('parsing  modulefile %s failed', f)
+                logging.error('parsing  modulefile %s failed', modulefile)
                 raise
-
-def parseTomlConfiguration(conffile):
+            if modulefile in pending:
+                stats.count('module files parsed')
+                stats.count('file patterns', sum(len(mod.patterns) for mod in modules))
+                stats.count('files found', sum(len(l) for mod in modules for l in mod.files.values()))
+                if cache: cache.store(modulefile, modules)
+            else:
+                stats.count('module files cached')
+            parsed[modulefile] = modules
+        if cache:
+            logging.debug('loaded %d module files from cache, parsed %d',
+                          cache.hits, cache.misses)
+        return [(path, [(f, parsed[f]) for f in files]) for path, files in found]
+
+def loadModules(moddb, basedir, paths, cache=None, jobs=1):
+    """load all modules from the search paths into the module database.
+    Modules are added in the order of discovery."""
+    paths = [os.path.abspath(os.path.join(basedir, path)) for path in paths]
+    for path, found in parseModuleDirs(paths, cache, jobs):
+        for modulefile, modules in found:
+            for mod in modules: moddb.addModule(mod)
+
+def readTomlConfiguration(conffile):
+    """parses a configuration file without loading its modules."""
     logging.info("processing configuration %s", conffile)
     with open(conffile, 'r') as fin:
         configf = toml.load(fin)
         configf = configf['config']
         config = Configuration(conffile)
+        config.vars["mcconf"] = mcconf_script
         config.moduledirs.append(os.path.join(mcconf_dir, "stdmodules"))
         for field in configf:
             if field == 'vars': config.vars.update(configf[field])
@@ -477,107 +2022,582 @@ def parseTomlConfiguration(conffile):
             elif field == 'requires': config.requires.update(configf['requires'])
             elif field == 'provides': config.provides.update(configf['provides'])
             elif field == 'modules': config.modules.update(configf['modules'])
+            elif field == 'database':
+                if configf['database'] not in ('toml', 'sqlite'):
+                    raise Exception("Unknown database format " + str(configf['database']))
+                config.database = configf['database']
             elif field == 'destdir':
                 config.dstdir = os.path.join(os.path.dirname(conffile), configf['destdir'])
-        loadModules(config.modDB, os.path.dirname(conffile), config.moduledirs)
         return config
 
+def parseTomlConfiguration(conffile, cache=None, jobs=1):
+    config = readTomlConfiguration(conffile)
+    loadModules(config.modDB, os.path.dirname(conffile), config.moduledirs, cache, jobs)
+    return config
+
+def configure(conffile, dstdir=None, resolveDeps=True, solver='greedy', budget=10.0,
+              cache=None, jobs=1):
+    """load a configuration with its modules and resolve its dependencies.
+    This is the entry point for using mcconf as a library. The returned
+    Configuration is not installed yet, its plan() lists what install()
+    would do. A ModuleCache that is passed to several calls keeps the parsed
+    modules and include scans, ModuleCache(None) keeps them in memory only."""
+    config = parseTomlConfiguration(os.path.abspath(conffile), cache, jobs)
+    if dstdir is not None: config.dstdir = dstdir
+    config.processModules(resolveDeps, solver, budget)
+    return config
+
+def loadBatch(conffiles, cache=None, jobs=1):
+    """parses several configuration files and the union of their module
+    directories, each module file is parsed only once. Every configuration
+    gets its own ModuleDB built from the shared Module objects of its own
+    search paths, in the same order as parseTomlConfiguration would load them.
+    Returns a list(Configuration)."""
+    configs = list()
+    paths = list()
+    for conffile in conffiles:
+        config = readTomlConfiguration(conffile)
+        config.searchPaths = [os.path.abspath(os.path.join(os.path.dirname(conffile), path))
+                              for path in config.moduledirs]
+        paths.extend(p for p in config.searchPaths if p not in paths)
+        configs.append(config)
+    parsed = dict(parseModuleDirs(paths, cache, jobs))
+    for config in configs:
+        for path in config.searchPaths:
+            for modulefile, modules in parsed[path]:
+                for mod in modules: config.modDB.addModule(mod)
+    return configs
+
+
+
+class DotWriter:
+    """writes a graph in the graphviz dot format while it is generated,
+    nodes and edges are not kept in memory."""
+
+    def __init__(self, fout, name='G'):
+        self.fout = fout
+        self.fout.write('digraph %s {\n' % self.quote(name))
+
+    @staticmethod
+    def quote(text):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def attributes(self, attrs):
+        if not attrs: return ''
+        return ' [' + ', '.join('%s=%s' % (k, self.quote(attrs[k])) for k in sorted(attrs)) + ']'
+
+    def node(self, name, **attrs):
+        self.fout.write(self.quote(name) + self.attributes(attrs) + ';\n')
+
+    def edge(self, src, dst, **attrs):
+        self.fout.write(self.quote(src) + ' -> ' + self.quote(dst) + self.attributes(attrs) + ';\n')
+
+    def close(self):
+        self.fout.write('}\n')
+
+def graphNeighbourhood(moddb, names, hops):
+    """Return the set of modules that are at most hops edges away from the named
+    modules, following dependency, inclusion and conflict edges in both directions."""
+    includers = dict()
+    for mod in moddb.getModules():
+        for name in mod.modules: includers.setdefault(name, set()).add(mod)
+    found = set()
+    for name in names:
+        if not moddb.has(name): raise Exception("Didn't find module " + name)
+        found.add(moddb[name])
+    frontier = set(found)
+    for hop in range(hops):
+        reached = set()
+        for mod in frontier:
+            reached.update(moddb.getSolutionCandidates(mod))
+            reached.update(moddb[n] for n in mod.modules if moddb.has(n))
+            reached.update(moddb.getConflictingModules(mod))
+            reached.update(includers.get(mod.name, ()))
+            for tag in mod.provides: reached.update(moddb.getRequires(tag))
+        frontier = reached - found
+        found.update(frontier)
+    return found
+
+def createModulesGraph(moddb, filename='dependencies.dot', modules=None, conflictsOnly=False):
+    """write the graph of all modules, or of the given set of modules, with
+    edges to the modules that satisfy their dependencies, edges for the
+    inclusion of modules and undirected edges for conflicts."""
+    mods = sorted(moddb.getModules() if modules is None else modules, key=lambda m: m.name)
+    shown = lambda mod: modules is None or mod in modules
+    with open(filename, 'w') as fout:
+        graph = DotWriter(fout)
+
+        # add modules as nodes
+        for mod in mods:
+            if conflictsOnly and not moddb.getConflictingModules(mod): continue
+            graph.node(mod.name, tooltip=", ".join(sorted(mod.provides)) + " ")
+
+        if not conflictsOnly:
+            # add directed edges from modules to modules that satisfy at least one dependency
+            for src in mods:
+                dstmods = moddb.getSolutionCandidates(src)
+                for dst in sorted(dstmods, key=lambda m: m.name):
+                    if not shown(dst): continue
+                    graph.edge(src.name, dst.name, tooltip=", ".join(sorted(dstmods[dst])) + " ")
+
+            # add special directed edges for "modules" inclusion
+            for src in mods:
+                for dstname in sorted(src.modules):
+                    if not moddb.has(dstname) or not shown(moddb[dstname]): continue
+                    graph.edge(src.name, dstname, color="green")
+
+        # add undirected edges for conflicts
+        for src in mods:
+            conflicts = moddb.getConflictingModules(src)
+            for dst in sorted(conflicts, key=lambda m: m.name):
+                if dst.name < src.name and shown(dst):
+                    graph.edge(src.name, dst.name, color="red", dir="none",
+                               tooltip=", ".join(sorted(conflicts[dst])) + " ")
+        graph.close()
 
+def createConfigurationGraph(modules, selectedmods, moddb, filename):
+    """write the graph of the modules of a configuration, the explicitly
+    selected modules are filled and modules with conflicts are drawn in red."""
+    mods = sorted(modules, key=lambda m: m.name)
+    with open(filename, 'w') as fout:
+        graph = DotWriter(fout)
+
+        # add modules as nodes
+        for mod in mods:
+            fc = "#BEF781" if mod.name in selectedmods else "white"
+            nc = "#DF0101" if moddb.getConflictingModules(mod) else "black"
+            graph.node(mod.name, tooltip=", ".join(sorted(mod.provides)) + " ",
+                       style='filled', fillcolor=fc, color=nc, fontcolor=nc)
+
+        # add directed edges from modules to modules that satisfy at least one dependency
+        for src in mods:
+            dstmods = moddb.getSolutionCandidates(src)
+            # don't show modules that are not in 'modules'
+            for dst in sorted(dstmods, key=lambda m: m.name):
+                if dst not in modules: continue
+                graph.edge(src.name, dst.name, tooltip=", ".join(sorted(dstmods[dst])) + " ")
+
+        # add special directed edges for "modules" inclusion
+        for src in mods:
+            for dstname in sorted(src.modules):
+                graph.edge(src.name, dstname, color="green")
+        graph.close()
+
+
+
+def addLogFile(configfile):
+    """start logging into <configfile>.log, returns the handler."""
+    logfile = configfile+'.log'
+    if os.path.exists(logfile): os.unlink(logfile)
+    fileHandler = logging.FileHandler(logfile)
+    fileHandler.setFormatter(logging.Formatter("%(message)s"))
+    fileHandler.setLevel(logging.DEBUG)
+    logging.getLogger().addHandler(fileHandler)
+    return fileHandler
 
-# TODO rewrite as mako template and drop pydot dependency
-def createModulesGraph(moddb):
-    graph = pydot.Dot(graph_type='digraph')
-    nodes = dict()
+def runConfiguration(config, args, jobs):
+    """check or resolve and install a configuration according to the command line."""
+    if(args.check):
+        with stats.phase('check'):
+            config.modDB.checkConsistency()
+            config.checkConsistency()
+    else:
+        with stats.phase('resolve'):
+            config.processModules(not args.nodepsolve, args.solver, args.solver_budget)
+        if args.dry_run:
+            with stats.phase('plan'):
+                config.plan(args.incremental, jobs).write(sys.stdout)
+        else:
+            with stats.phase('install'):
+                config.install(args.incremental, jobs)
 
-    # add modules as nodes
-    for mod in moddb.getModules():
-        tt = ", ".join(mod.provides) + " "
-        node = pydot.Node(mod.name, tooltip=tt)
-        nodes[mod.name] = node
-        graph.add_node(node)
-
-    # add directed edges from modules to modules that satisfy at least one dependency
-    for src in moddb.getModules():
-        dstmods = moddb.getSolutionCandidates(src)
-        for dst in dstmods:
-            tt = ", ".join(dstmods[dst]) + " "
-            edge = pydot.Edge(src.name, dst.name, tooltip=tt)
-            graph.add_edge(edge)
-
-    # add special directed edges for "modules" inclusion
-    for src in moddb.getModules():
-        for dstname in src.modules:
-            dst = moddb[dstname]
-            edge = pydot.Edge(src.name, dst.name, color="green")
-            graph.add_edge(edge)
-
-    # add undirected edges for conflicts
-    for src in moddb.getModules():
-        conflicts = moddb.getConflictingModules(src)
-        for dst in conflicts:
-            if (dst.name < src.name):
-                tt = ", ".join(conflicts[dst]) + " "
-                edge = pydot.Edge(src.name, dst.name, color="red", dir="none", tooltip=tt)
-                graph.add_edge(edge)
-
-    graph.write('dependencies.dot')
-
-
-# TODO rewrite as mako template and drop pydot dependency
-def createConfigurationGraph(modules, selectedmods, moddb, filename):
-    graph = pydot.Dot(graph_name="G", graph_type='digraph')
-    nodes = dict()
-
-    # add modules as nodes
-    for mod in modules:
-        tt = ", ".join(mod.provides) + " "
-        if mod.name in selectedmods:
-            fc = "#BEF781"
+    if args.modulegraph:
+        with stats.phase('graphs'):
+            modules = None
+            if args.graph_selected:
+                modules = config.acceptedMods or set(config.modDB[n] for n in config.modules
+                                                     if config.modDB.has(n))
+            if args.graph_around:
+                around = graphNeighbourhood(config.modDB, args.graph_around, args.graph_hops)
+                modules = around if modules is None else modules & around
+            createModulesGraph(config.modDB, 'dependencies.dot', modules, args.graph_conflicts)
+            createConfigurationGraph(config.acceptedMods, config.modules, config.modDB, config.dstdir+'/config.dot')
+
+def objectFile(dstfile):
+    """Return the name of the object file built from a source, or None."""
+    for suffix in ['.cc', '.S', '.c']:
+        if dstfile.endswith(suffix): return dstfile[:-len(suffix)] + '.o'
+    return None
+
+def reportAffected(configs, changed, out):
+    """write the variants, modules, destination files and object files that
+    are affected by the changed files, one per line prefixed by its kind."""
+    for config in configs:
+        with stats.phase('affected'):
+            files = config.affectedFiles(changed)
+        if not files: continue
+        name = os.path.relpath(config.vars['config_file'])
+        out.write('variant %s\n' % name)
+        for mod in sorted(set(config.allfiles[f].module.name for f in files)):
+            out.write('module %s %s\n' % (name, mod))
+        for f in sorted(files):
+            out.write('file %s %s\n' % (name, f))
+        for obj in sorted(set(objectFile(f) for f in files) - set([None])):
+            out.write('object %s %s\n' % (name, obj))
+
+def parseAlternatives(moddb, specs):
+    """Return the list of (tag, list of module names) for the --enumerate
+    arguments TAG, which stands for all modules providing TAG including noauto
+    modules, or TAG=MODULE,MODULE,... for a chosen set of alternatives."""
+    alternatives = list()
+    for spec in specs:
+        tag, sep, names = spec.partition('=')
+        if sep:
+            names = [n for n in names.split(',') if n]
         else:
-            fc = "white"
-        if moddb.getConflictingModules(mod):
-            nc = "#DF0101"
+            providers = set(moddb.getProvides(tag)) | moddb.noautoProvides.get(tag, set())
+            names = sorted(m.name for m in providers)
+        if not names: raise Exception("no module provides " + tag)
+        alternatives.append((tag, names))
+    return alternatives
+
+enumState = None # (configs, args), inherited by the enumeration worker processes
+
+def resolveVariant(i):
+    """resolve one variant of an enumeration without installing it.
+    Returns (names of the added modules, sorted missing tags, error message or None)."""
+    configs, args = enumState
+    config = configs[i]
+    logging.disable(logging.WARNING) # unresolved tags are part of the report
+    try:
+        added = config.processModules(not args.nodepsolve, args.solver, args.solver_budget)
+        return (sorted(m.name for m in added), sorted(config.getMissingRequires()), None)
+    except Exception as e:
+        return ([], [], '%s: %s' % (type(e).__name__, e))
+    finally:
+        logging.disable(logging.NOTSET)
+
+def enumerateConfiguration(config, alternatives, args, out):
+    """enumerate the variants of a configuration, resolve the ones that survive
+    the pruning by args.jobs worker processes, and write one line per variant
+    to out: 'valid' or 'invalid', the choices TAG=MODULE, and the added modules
+    or the reason. Returns the number of invalid variants and pruned branches."""
+    global enumState
+    with stats.phase('enumerate'):
+        variants = config.enumerateVariants(alternatives)
+    complete = [choices for choices, reason in variants if reason is None]
+    config.modDB.requires # scan the includes before the workers fork
+    enumState = ([config.variant(name for tag, name in choices) for choices in complete], args)
+    with stats.phase('resolve'):
+        if args.jobs > 1 and len(complete) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(args.jobs, len(complete)))
+            try:
+                resolved = pool.map(resolveVariant, range(len(complete)))
+            finally:
+                pool.close()
+                pool.join()
         else:
-            nc = "black"
-
-        node = pydot.Node(mod.name, tooltip=tt,
-                          style='filled', fillcolor=fc, color=nc, fontcolor=nc)
-        # node = pydot.Node(mod.name)
-        nodes[mod.name] = node
-        graph.add_node(node)
+            resolved = [resolveVariant(i) for i in range(len(complete))]
+    stats.count('variants resolved', len(complete))
+
+    results = iter(resolved)
+    invalid = 0
+    for choices, reason in variants:
+        line = ' '.join('%s=%s' % c for c in choices)
+        if reason is None:
+            added, missing, error = next(results)
+            if error: reason = error
+            elif missing: reason = 'unresolved ' + ', '.join(missing)
+            else:
+                out.write('valid %s added=%s\n' % (line, ','.join(added)))
+                continue
+        if len(choices) < len(alternatives):
+            line += ' ' + ' '.join('%s=*' % tag for tag, names in alternatives[len(choices):])
+        out.write('invalid %s: %s\n' % (line, reason))
+        invalid += 1
+    logging.info('enumerated %d variants: %d pruned branches, %d resolved, %d valid',
+                 len(variants), len(variants)-len(complete), len(complete), len(variants)-invalid)
+    return invalid
+
+variantState = None # (configs, args) of a batch, set up in each worker process
+
+def initVariantWorker(state, tags, templates, memo, level):
+    """set up a worker process for the variants of a batch.
+    The interned tags, the template directory, the include scans and the log
+    level are passed along, so that the worker matches the parent process
+    also if it was spawned instead of forked."""
+    global variantState
+    variantState = state
+    if len(tagTable.tags) < len(tags):
+        tagTable.tags = list(tags)
+        tagTable.ids = dict((tag, i) for i, tag in enumerate(tags))
+    templateCache.directory = templates
+    includeScanner.memo.update(memo)
+    logging.getLogger().setLevel(level)
+
+def variantPool(jobs, configs, args):
+    """Return a pool of worker processes for the variants of a batch."""
+    import multiprocessing
+    return multiprocessing.Pool(min(jobs, len(configs)), initVariantWorker,
+                                ((configs, args), tagTable.tags, templateCache.directory,
+                                 includeScanner.memo, logging.getLogger().level))
+
+def runBatchVariant(i):
+    """configure one variant of a batch, logging into its own log file.
+    Returns the error message or None on success."""
+    configs, args = variantState
+    config = configs[i]
+    fileHandler = addLogFile(config.vars["config_file"])
+    try:
+        runConfiguration(config, args, 1)
+        return None
+    except Exception as e:
+        logging.error('configuring %s failed: %s', config.vars["config_file"], e)
+        return '%s: %s' % (type(e).__name__, e)
+    finally:
+        logging.getLogger().removeHandler(fileHandler)
+        fileHandler.close()
+
+class ConfigServer:
+    """keeps the module database, the include scans and the compiled templates
+    of a configuration in memory and reconfigures it on request or on changes.
+
+    Requests are read from a Unix socket, one command line per connection:
+    'reconfigure' runs an incremental configuration and sends the log messages
+    followed by 'ok' or 'error', 'ping' answers 'ok', 'shutdown' stops the server.
+    In watch mode, the configuration file, the module directories, the module
+    files and the source files of the configuration are polled for changes.
+    """
 
-    # add directed edges from modules to modules that satisfy at least one dependency
-    for src in modules:
-        dstmods = moddb.getSolutionCandidates(src)
-        #print(str(src) + ' --> ' + str(dstmods))
-        # don't show modules that are not in 'modules'
-        for dst in dstmods:
-            if dst not in modules: continue
-            tt = ", ".join(dstmods[dst]) + " "
-            edge = pydot.Edge(src.name, dst.name, tooltip=tt)
-            # edge = pydot.Edge(src.name, dst.name)
-            graph.add_edge(edge)
+    def __init__(self, configfile, args, cache):
+        self.configfile = configfile
+        self.args = args
+        self.cache = cache or ModuleCache(None)
+        self.lock = threading.RLock()
+        self.config = None
+        self.snapshot = None
+        self.running = True
+
+    def reconfigure(self):
+        with self.lock:
+            try:
+                self.cache.hits = self.cache.misses = 0
+                config = configure(self.configfile, self.args.destpath, not self.args.nodepsolve,
+                                   self.args.solver, self.args.solver_budget,
+                                   self.cache, self.args.jobs)
+                config.install(True, self.args.jobs)
+                self.config = config
+                self.cache.save()
+            finally:
+                self.snapshot = self.takeSnapshot()
+
+    def takeSnapshot(self):
+        """Return the fingerprints of everything a reconfiguration depends on."""
+        with self.lock:
+            paths = set([self.configfile])
+            paths.update(self.cache.entries.keys())
+            if self.config is not None:
+                basedir = os.path.dirname(self.configfile)
+                for path in self.config.moduledirs:
+                    root = os.path.abspath(os.path.join(basedir, path))
+                    paths.update(os.path.join(root, d) for d in DirIndex(root).dirs)
+                paths.update(mf.srcfile for mf in self.config.allfiles.values())
+            return dict((path, statKey(path)) for path in paths)
+
+    def watch(self):
+        while self.running:
+            time.sleep(self.args.poll_interval)
+            if self.takeSnapshot() == self.snapshot: continue
+            logging.info('detected changes, reconfiguring %s', self.configfile)
+            try:
+                self.reconfigure()
+            except Exception as e:
+                logging.error('reconfiguration failed: %s', e)
+
+    def handle(self, conn):
+        command = conn.makefile('r').readline().strip()
+        out = conn.makefile('w')
+        if command == 'ping':
+            out.write('ok\n')
+        elif command == 'shutdown':
+            self.running = False
+            out.write('ok\n')
+        elif command == 'reconfigure':
+            handler = logging.StreamHandler(out)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            handler.setLevel(logging.INFO)
+            logging.getLogger().addHandler(handler)
+            try:
+                self.reconfigure()
+                status = 'ok'
+            except Exception as e:
+                logging.error('reconfiguration failed: %s', e)
+                status = 'error'
+            finally:
+                logging.getLogger().removeHandler(handler)
+            out.write(status+'\n')
+        else:
+            out.write('error unknown command '+command+'\n')
+        out.flush()
+
+    def serve(self, sockname):
+        import socket
+        if os.path.exists(sockname): os.unlink(sockname)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(sockname)
+        server.listen(5)
+        logging.info('listening on %s', sockname)
+        try:
+            while self.running:
+                conn, addr = server.accept()
+                try:
+                    self.handle(conn)
+                except Exception as e:
+                    logging.warning('request failed: %s', e)
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.unlink(sockname)
+
+def run(args):
+    """run mcconf for the parsed command line, returns the exit status."""
+    global variantState
+    if args.batch: args.configfile = args.batch[0]
+    args.configfile = os.path.abspath(args.configfile)
+    cache = None
+    if not args.nocache:
+        cache = ModuleCache(os.path.abspath(args.cache or args.configfile+'.cache'))
+        cache.load()
+        templateCache.directory = os.path.abspath(args.template_cache or args.configfile+'.templates')
+    includeScanner.jobs = args.jobs
+
+    if args.affected:
+        with stats.phase('load'):
+            if args.batch:
+                configs = loadBatch([os.path.abspath(f) for f in args.batch], cache, args.jobs)
+            else:
+                configs = [parseTomlConfiguration(args.configfile, cache, args.jobs)]
+        for config in configs:
+            with stats.phase('resolve'):
+                config.processModules(not args.nodepsolve, args.solver, args.solver_budget)
+        reportAffected(configs, set(os.path.abspath(f) for f in args.affected), sys.stdout)
+        if cache: cache.save()
+        return 0
+
+    if args.enumerate:
+        with stats.phase('load'):
+            config = parseTomlConfiguration(args.configfile, cache, args.jobs)
+        invalid = enumerateConfiguration(config, parseAlternatives(config.modDB, args.enumerate),
+                                         args, sys.stdout)
+        if cache: cache.save()
+        return 1 if invalid else 0
+
+    if args.batch:
+        with stats.phase('load'):
+            configs = loadBatch([os.path.abspath(f) for f in args.batch], cache, args.jobs)
+        variantState = (configs, args)
+        if args.jobs > 1 and len(configs) > 1:
+            pool = variantPool(args.jobs, configs, args)
+            try:
+                errors = pool.map(runBatchVariant, range(len(configs)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = [runBatchVariant(i) for i in range(len(configs))]
+        failed = [c.vars["config_file"] for c, e in zip(configs, errors) if e is not None]
+        logging.info('configured %d of %d variants', len(configs)-len(failed), len(configs))
+        for f in failed: logging.error('failed variant: %s', f)
+        if cache: cache.save()
+        return 1 if failed else 0
+
+    if args.serve:
+        server = ConfigServer(args.configfile, args, cache)
+        try:
+            server.reconfigure()
+        except Exception as e:
+            logging.error('configuration failed: %s', e)
+        if args.watch:
+            watcher = threading.Thread(target=server.watch)
+            watcher.daemon = True
+            watcher.start()
+        server.serve(os.path.abspath(args.socket or args.configfile+'.sock'))
+        return 0
 
-    # add special directed edges for "modules" inclusion
-    for src in modules:
-        for dstname in src.modules:
-            dst = moddb[dstname]
-            edge = pydot.Edge(src.name, dst.name, color="green")
-            graph.add_edge(edge)
+    with stats.phase('load'):
+        config = parseTomlConfiguration(args.configfile, cache, args.jobs)
 
-    graph.write(filename)
+    if args.destpath is not None:
+        config.dstdir = args.destpath
 
+    runConfiguration(config, args, args.jobs)
 
+    if cache:
+        with stats.phase('save cache'): cache.save()
+    return 0
 
-if __name__ == '__main__':
+def main(argv=None):
+    """run mcconf with the command line arguments, returns the exit status."""
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', "--configfile", default = 'project.config')
+    parser.add_argument("--batch", nargs = '+', metavar = 'CONFIGFILE',
+                        help = 'configure several variants with a shared module database')
     parser.add_argument('-d', "--destpath")
+    parser.add_argument("--enumerate", nargs = '+', metavar = 'TAG[=MODULE,...]',
+                        help = 'resolve all combinations of alternative providers of these tags and report the valid variants')
+    parser.add_argument("--dry-run", action = 'store_true',
+                        help = 'print the install plan as JSON instead of installing')
+    parser.add_argument("--affected", nargs = '+', metavar = 'FILE',
+                        help = 'report the variants, modules and object files affected by changes of these files')
     parser.add_argument("--check", action = 'store_true')
     parser.add_argument('-v', "--verbose", action = 'store_true')
     parser.add_argument('-g', "--modulegraph", action = 'store_true')
+    parser.add_argument('--graph-around', nargs = '+', metavar = 'MODULE',
+                        help = 'restrict the module graph to the neighbourhood of these modules')
+    parser.add_argument('--graph-hops', type = int, default = 1,
+                        help = 'size of the neighbourhood in edges, default 1')
+    parser.add_argument('--graph-selected', action = 'store_true',
+                        help = 'restrict the module graph to the modules of the configuration')
+    parser.add_argument('--graph-conflicts', action = 'store_true',
+                        help = 'show only modules with conflicts and the conflict edges')
     parser.add_argument("--nodepsolve", help = 'disables the solver', action = 'store_true')
-    args = parser.parse_args()
+    parser.add_argument("--solver", choices = ['greedy', 'sat'], default = 'greedy',
+                        help = 'dependency resolution engine')
+    parser.add_argument("--solver-budget", type = float, default = 10.0,
+                        help = 'time budget of the sat solver in seconds')
+    parser.add_argument("--incremental", action = 'store_true',
+                        help = 'keep unchanged files and remove files of the previous run that are not needed anymore')
+    parser.add_argument("--cache", help = 'module cache file, default is <configfile>.cache')
+    parser.add_argument("--template-cache", help = 'directory for compiled templates, default is <configfile>.templates')
+    parser.add_argument("--nocache", help = 'disables the module and template caches', action = 'store_true')
+    parser.add_argument('-j', "--jobs", type = int, default = 1,
+                        help = 'number of worker processes for parsing and scanning, and of threads for installing')
+    parser.add_argument("--serve", action = 'store_true',
+                        help = 'keep running and reconfigure incrementally on request of mcconf -r')
+    parser.add_argument("--watch", action = 'store_true',
+                        help = 'with --serve, also reconfigure when module files or sources change')
+    parser.add_argument("--poll-interval", type = float, default = 1.0,
+                        help = 'seconds between two checks for changes in watch mode')
+    parser.add_argument("--socket", help = 'socket of the server, default is <configfile>.sock')
+    parser.add_argument("--stats", action = 'store_true',
+                        help = 'print the time per phase and event counters')
+    parser.add_argument("--stats-json", metavar = 'FILE',
+                        help = 'write the time per phase, event counters and a trace of the phases as JSON')
+    parser.add_argument("--profile", metavar = 'FILE', help = 'write cProfile statistics')
+    args = parser.parse_args(argv)
+
+    if args.batch and args.destpath is not None:
+        parser.error('--destpath cannot be used with --batch')
+    if args.batch and args.serve:
+        parser.error('--serve cannot be used with --batch')
+    if args.affected and args.serve:
+        parser.error('--serve cannot be used with --affected')
+    if args.dry_run and (args.batch or args.serve):
+        parser.error('--dry-run cannot be used with --batch or --serve')
+    if args.enumerate and (args.batch or args.serve or args.affected or args.dry_run):
+        parser.error('--enumerate cannot be used with --batch, --serve, --affected or --dry-run')
 
     # make destination path absolute (was relative to caller's working directory)
     if args.destpath is not None:
@@ -586,14 +2606,12 @@ if __name__ == '__main__':
     # configure the logging
     logFormatter = logging.Formatter("%(message)s")
     rootLogger = logging.getLogger()
-    logfile = args.configfile+'.log'
-    if os.path.exists(logfile): os.unlink(logfile)
-    fileHandler = logging.FileHandler(logfile)
-    fileHandler.setFormatter(logFormatter)
-    fileHandler.setLevel(logging.DEBUG)
-    rootLogger.addHandler(fileHandler)
+    if not args.batch: addLogFile(args.configfile)
 
-    consoleHandler = logging.StreamHandler(sys.stdout)
+    # the reports of --affected and --enumerate and the plan of --dry-run go to stdout,
+    # log messages to stderr
+    consoleHandler = logging.StreamHandler(sys.stderr if args.affected or args.dry_run or args.enumerate
+                                           else sys.stdout)
     consoleHandler.setFormatter(logFormatter)
     if args.verbose:
         consoleHandler.setLevel(logging.DEBUG)
@@ -602,22 +2620,23 @@ if __name__ == '__main__':
     rootLogger.addHandler(consoleHandler)
     rootLogger.setLevel(logging.DEBUG)
 
-    args.configfile = os.path.abspath(args.configfile)
-    config = parseTomlConfiguration(args.configfile)
-    config.vars["mcconf"] = os.path.abspath(sys.argv[0])
-
-    if args.destpath is not None:
-        config.dstdir = args.destpath
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        status = run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats: stats.summary()
+        if args.stats_json: stats.writeJson(args.stats_json)
+    return status
 
-    if(args.check):
-        config.modDB.checkConsistency()
-        config.checkConsistency()
-    else:
-        config.processModules(not args.nodepsolve)
-        config.install()
-
-    if args.modulegraph:
-        createModulesGraph(config.modDB)
-        createConfigurationGraph(config.acceptedMods, config.modules, config.modDB, config.dstdir+'/config.dot')
-
-    sys.exit(0)
+if __name__ == '__main__':
+    # run as the imported module mcconf, so that pickled objects refer to mcconf.Module
+    # instead of __main__.Module and the caches can be shared with library users
+    import mcconf
+    sys.exit(mcconf.main())